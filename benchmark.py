@@ -0,0 +1,182 @@
+#######################################################################
+# Copyright (C) 2017 Shangtong Zhang(zhangshangtong.cpp@gmail.com)    #
+# Permission given to modify the code as long as you keep this        #
+# declaration at the top                                              #
+#######################################################################
+
+import json
+from deep_rl import *
+from deep_rl.component.envs import RemoteEnvServer
+
+
+def env_families():
+    families = OrderedDict([('classic_control', 'CartPole-v0')])
+    try:
+        import atari_py
+        families['atari'] = 'BreakoutNoFrameskip-v4'
+    except ImportError:
+        pass
+    try:
+        import mujoco_py
+        families['mujoco'] = 'HalfCheetah-v2'
+    except ImportError:
+        pass
+    return families
+
+
+def serve_remote_envs(port):
+    RemoteEnvServer('localhost', port).serve_forever()
+
+
+def env_backends(max_envs, remote_ports=(6000, 6001)):
+    pool = []
+    servers = []
+
+    def pooled(game, num_envs):
+        if not pool:
+            pool.append(EnvPool(num_workers=max_envs))
+        return Task(game, num_envs=num_envs, env_pool=pool[0])
+
+    def remote(game, num_envs):
+        if not servers:
+            for port in remote_ports:
+                server = mp.Process(target=serve_remote_envs, args=(port,), daemon=True)
+                server.start()
+                servers.append(server)
+            time.sleep(1)
+        return Task(game, num_envs=num_envs, remote_workers=['localhost:%d' % port for port in remote_ports])
+
+    backends = OrderedDict([
+        ('dummy', lambda game, num_envs: Task(game, num_envs=num_envs, single_process=True)),
+        ('subproc', lambda game, num_envs: Task(game, num_envs=num_envs, single_process=False)),
+        ('dummy_async_reset', lambda game, num_envs: Task(
+            game, num_envs=num_envs, single_process=True, async_reset=True)),
+        ('subproc_async_reset', lambda game, num_envs: Task(
+            game, num_envs=num_envs, single_process=False, async_reset=True)),
+        ('pool', pooled),
+        ('remote', remote),
+    ])
+    return backends, pool, servers
+
+
+# Steps a task with a random policy, so only the env side is measured
+def benchmark_task(task, num_envs, steps, warm_up):
+    task.reset()
+    latencies = []
+    for i in range(warm_up + steps):
+        actions = [task.action_space.sample() for _ in range(num_envs)]
+        t0 = time.perf_counter()
+        task.step(actions)
+        if i >= warm_up:
+            latencies.append(time.perf_counter() - t0)
+    latencies = np.asarray(latencies) * 1e3
+    return {
+        'steps_per_s': num_envs * steps / (latencies.sum() / 1e3),
+        'latency_ms_mean': float(latencies.mean()),
+        'latency_ms_p50': float(np.percentile(latencies, 50)),
+        'latency_ms_p90': float(np.percentile(latencies, 90)),
+        'latency_ms_p99': float(np.percentile(latencies, 99)),
+    }
+
+
+def benchmark_envs(num_envs_list=(1, 4, 8, 16), steps=2000, warm_up=100):
+    backends, pool, servers = env_backends(max(num_envs_list))
+    report = []
+    for family, game in env_families().items():
+        for backend, task_fn in backends.items():
+            for num_envs in num_envs_list:
+                task = task_fn(game, num_envs)
+                result = benchmark_task(task, num_envs, steps, warm_up)
+                task.close()
+                result.update(family=family, game=game, backend=backend, num_envs=num_envs)
+                print('%s %s num_envs=%d: %.1f steps/s, p50 %.3f ms, p99 %.3f ms' % (
+                    game, backend, num_envs, result['steps_per_s'],
+                    result['latency_ms_p50'], result['latency_ms_p99']))
+                report.append(result)
+    for p in pool:
+        p.close()
+    for server in servers:
+        server.terminate()
+    return report
+
+
+def dqn_actor_config(game, pixel, backend):
+    config = Config()
+    config.game = game
+    config.task_fn = lambda: Task(config.game)
+    config.eval_env = config.task_fn()
+    if pixel:
+        config.history_length = 4
+        config.network_fn = lambda: VanillaNet(config.action_dim, NatureConvBody(in_channels=config.history_length))
+        config.state_normalizer = ImageNormalizer()
+    else:
+        config.network_fn = lambda: VanillaNet(config.action_dim, FCBody(config.state_dim))
+    config.random_action_prob = LinearSchedule(0.1)
+    config.exploration_steps = 0
+    config.sgd_update_frequency = 4
+    config.async_actor = True
+    config.actor_backend = backend
+    config.lock = mp.Lock()
+    return config
+
+
+# Times DQNActor.step, i.e. one batch of sgd_update_frequency transitions,
+# as seen by the learner
+def benchmark_actor(config, steps, warm_up):
+    network = config.network_fn()
+    network.share_memory()
+    actor = DQNActor(config)
+    actor.set_network(network)
+    latencies = []
+    for i in range(warm_up + steps):
+        t0 = time.perf_counter()
+        actor.step()
+        if i >= warm_up:
+            latencies.append(time.perf_counter() - t0)
+    actor.close()
+    config.eval_env.close()
+    latencies = np.asarray(latencies) * 1e3
+    return {
+        'transitions_per_s': config.sgd_update_frequency * steps / (latencies.sum() / 1e3),
+        'latency_ms_mean': float(latencies.mean()),
+        'latency_ms_p50': float(np.percentile(latencies, 50)),
+        'latency_ms_p99': float(np.percentile(latencies, 99)),
+    }
+
+
+def benchmark_actors(steps=2000, warm_up=100):
+    games = OrderedDict([('dqn_feature', ('CartPole-v0', False))])
+    if 'atari' in env_families():
+        games['dqn_pixel'] = ('BreakoutNoFrameskip-v4', True)
+    report = []
+    for example, (game, pixel) in games.items():
+        for backend in ['process', 'thread']:
+            result = benchmark_actor(dqn_actor_config(game, pixel, backend), steps, warm_up)
+            result.update(example=example, game=game, backend=backend)
+            print('%s %s: %.1f transitions/s, p50 %.3f ms, p99 %.3f ms' % (
+                example, backend, result['transitions_per_s'],
+                result['latency_ms_p50'], result['latency_ms_p99']))
+            report.append(result)
+    return report
+
+
+if __name__ == '__main__':
+    mkdir('log')
+    set_one_thread()
+    random_seed()
+
+    cf = Config()
+    cf.add_argument('--suite', type=str, default='env', choices=['env', 'actor'])
+    cf.add_argument('--steps', type=int, default=2000)
+    cf.add_argument('--num_envs', type=int, nargs='+', default=[1, 4, 8, 16])
+    cf.add_argument('--output', type=str, default=None)
+    cf.merge()
+
+    if cf.output is None:
+        cf.output = './log/%s_benchmark-%s.json' % (cf.suite, get_time_str())
+    if cf.suite == 'env':
+        report = benchmark_envs(cf.num_envs, cf.steps)
+    else:
+        report = benchmark_actors(cf.steps)
+    with open(cf.output, 'w') as f:
+        json.dump(report, f, indent=2)
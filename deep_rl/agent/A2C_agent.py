@@ -13,27 +13,44 @@ class A2CAgent(BaseAgent):
     def __init__(self, config):
         BaseAgent.__init__(self, config)
         self.config = config
-        self.task = config.task_fn()
+        self.task = None
         self.network = config.network_fn()
-        self.optimizer = config.optimizer_fn(self.network.parameters())
+        if config.flat_parameters and config.num_learners > 1:
+            # share_memory() would also share the flat gradient buffer between the learners
+            raise ValueError('flat_parameters is not supported with num_learners > 1')
+        self.flat = FlatParameters(self.network) if config.flat_parameters else None
         self.total_steps = 0
+        if config.num_learners > 1:
+            self.start_learners()
+        else:
+            self.set_up_learner()
+
+    def set_up_learner(self):
+        config = self.config
+        self.task = config.task_fn()
+        self.optimizer = config.optimizer_fn(self.network.parameters())
         self.states = self.task.reset()
 
     def step(self):
+        if self.learners:
+            self.hogwild_step()
+        else:
+            self.learn()
+
+    def learn(self):
         config = self.config
         storage = Storage(config.rollout_length)
         states = self.states
         for _ in range(config.rollout_length):
             prediction = self.network(config.state_normalizer(states))
             next_states, rewards, terminals, info = self.task.step(to_np(prediction['action']))
-            self.record_online_return(info)
+            self.track_env_step(info)
             rewards = config.reward_normalizer(rewards)
             storage.feed(prediction)
             storage.feed({'reward': tensor(rewards).unsqueeze(-1),
                          'mask': tensor(1 - terminals).unsqueeze(-1)})
 
             states = next_states
-            self.total_steps += config.num_workers
 
         self.states = states
         prediction = self.network(config.state_normalizer(states))
@@ -57,8 +74,14 @@ class A2CAgent(BaseAgent):
         value_loss = 0.5 * (entries.ret - entries.v).pow(2).mean()
         entropy_loss = entries.entropy.mean()
 
-        self.optimizer.zero_grad()
+        if self.flat is not None:
+            self.flat.zero_grad()
+        else:
+            self.optimizer.zero_grad()
         (policy_loss - config.entropy_weight * entropy_loss +
          config.value_loss_weight * value_loss).backward()
-        nn.utils.clip_grad_norm_(self.network.parameters(), config.gradient_clip)
+        if self.flat is not None:
+            self.flat.clip_grad_norm_(config.gradient_clip)
+        else:
+            nn.utils.clip_grad_norm_(self.network.parameters(), config.gradient_clip)
         self.optimizer.step()
@@ -8,6 +8,9 @@ import torch
 import numpy as np
 from ..utils import *
 import torch.multiprocessing as mp
+import queue
+import copy
+import threading
 from collections import deque
 from skimage.io import imsave
 
@@ -17,9 +20,56 @@ class BaseAgent:
         self.config = config
         self.logger = get_logger(tag=config.tag, log_level=config.log_level)
         self.task_ind = 0
+        self.learners = []
+        self.learner_queue = None
 
     def close(self):
+        for learner in self.learners:
+            learner.terminate()
         close_obj(self.task)
+        close_obj(self.config.eval_env)
+
+    def start_learners(self):
+        # Every learner process would update its own copy of the running statistics,
+        # while eval_step and save in the main process only see the initial ones
+        for normalizer in [self.config.state_normalizer, self.config.reward_normalizer]:
+            if isinstance(normalizer, MeanStdNormalizer):
+                raise ValueError('MeanStdNormalizer is not supported with num_learners > 1')
+        # Learner processes carry the whole agent (logger, config with its parser),
+        # which only a forked child inherits
+        if mp.get_start_method() != 'fork':
+            raise ValueError('num_learners > 1 requires the fork start method')
+        self.network.share_memory()
+        self.learner_queue = mp.Queue()
+        self.learners = [HogwildLearner(self) for _ in range(self.config.num_learners)]
+
+    # Called by learn() after each step of the num_workers envs,
+    # learner processes leave logging and step counting to the main process
+    def track_env_step(self, info):
+        if self.learner_queue is not None:
+            self.learner_queue.put(info)
+        else:
+            self.record_online_return(info)
+            self.total_steps += self.config.num_workers
+
+    def hogwild_step(self):
+        while True:
+            try:
+                infos = [self.learner_queue.get(timeout=1)]
+                break
+            except queue.Empty:
+                # A learner that raised has printed its traceback and exited
+                for learner in self.learners:
+                    if not learner.is_alive():
+                        raise RuntimeError('Hogwild learner %s exited with code %s' % (learner.name, learner.exitcode))
+        while True:
+            try:
+                infos.append(self.learner_queue.get_nowait())
+            except queue.Empty:
+                break
+        for info in infos:
+            self.record_online_return(info)
+            self.total_steps += self.config.num_workers
 
     def save(self, filename):
         torch.save(self.network.state_dict(), '%s.model' % (filename))
@@ -68,6 +118,11 @@ class BaseAgent:
         elif isinstance(info, tuple):
             for i, info_ in enumerate(info):
                 self.record_online_return(info_, i)
+        elif isinstance(info, np.ndarray):
+            # Episodic returns of a structured batch, NaN while an episode runs
+            for i, ret in enumerate(info):
+                if not np.isnan(ret):
+                    self.record_online_return({'episodic_return': ret}, offset + i)
         else:
             raise NotImplementedError
 
@@ -105,6 +160,30 @@ class BaseAgent:
         imsave('%s/%04d.png' % (dir, steps), obs)
 
 
+# In-process stand-in for one end of mp.Pipe, objects are passed by reference
+class ThreadPipe:
+    def __init__(self, inbox, outbox):
+        self.inbox = inbox
+        self.outbox = outbox
+
+    def send(self, obj):
+        self.outbox.put(obj)
+
+    def recv(self):
+        return self.inbox.get()
+
+    def poll(self):
+        return not self.inbox.empty()
+
+    def close(self):
+        pass
+
+
+def thread_pipe():
+    a, b = queue.Queue(), queue.Queue()
+    return ThreadPipe(a, b), ThreadPipe(b, a)
+
+
 class BaseActor(mp.Process):
     STEP = 0
     RESET = 1
@@ -116,18 +195,30 @@ class BaseActor(mp.Process):
     def __init__(self, config):
         mp.Process.__init__(self)
         self.config = config
-        self.__pipe, self.__worker_pipe = mp.Pipe()
+        if config.async_actor and config.actor_backend == 'process':
+            self.config = config.spec()
+        if config.actor_backend == 'thread':
+            # Same protocol run by a thread, transitions and the network are not pickled
+            self.__pipe, self.__worker_pipe = thread_pipe()
+            self.__thread = threading.Thread(target=self.run, daemon=True)
+            self.start = self.__thread.start
+        elif config.actor_backend == 'process':
+            self.__pipe, self.__worker_pipe = mp.Pipe()
+        else:
+            raise NotImplementedError
 
         self._state = None
         self._task = None
         self._network = None
+        self._weights = None
         self._total_steps = 0
+        self._seed = np.random.randint(int(1e9))
         self.__cache_len = 2
 
         if not config.async_actor:
             self.start = lambda: None
             self.step = self._sample
-            self.close = lambda: None
+            self.close = lambda: close_obj(self._task)
             self._set_up()
             self._task = config.task_fn()
 
@@ -140,6 +231,8 @@ class BaseActor(mp.Process):
         return transitions
 
     def run(self):
+        if self.config.actor_backend == 'process':
+            random_seed(self._seed)
         self._set_up()
         config = self.config
         self._task = config.task_fn()
@@ -154,13 +247,24 @@ class BaseActor(mp.Process):
                 self.__worker_pipe.send(cache.popleft())
                 cache.append(self._sample())
             elif op == self.EXIT:
+                close_obj(self._task)
                 self.__worker_pipe.close()
                 return
             elif op == self.NETWORK:
-                self._network = data
+                self._network, self._weights = data
             else:
                 raise NotImplementedError
 
+    # Class level settings are not inherited under spawn/forkserver
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_class_config'] = (Config.DEVICE, Config.NOISY_LAYER_STD)
+        return state
+
+    def __setstate__(self, state):
+        Config.DEVICE, Config.NOISY_LAYER_STD = state.pop('_class_config')
+        self.__dict__.update(state)
+
     def _transition(self):
         raise NotImplementedError
 
@@ -168,15 +272,136 @@ class BaseActor(mp.Process):
         pass
 
     def step(self):
+        self.step_async()
+        return self.step_wait()
+
+    def step_async(self):
         self.__pipe.send([self.STEP, None])
+
+    def step_wait(self):
         return self.__pipe.recv()
 
+    def poll(self):
+        return self.__pipe.poll()
+
     def close(self):
         self.__pipe.send([self.EXIT, None])
         self.__pipe.close()
 
-    def set_network(self, net):
+    def join(self, timeout=None):
+        if not self.config.async_actor:
+            return
+        if self.config.actor_backend == 'thread':
+            self.__thread.join(timeout)
+        else:
+            mp.Process.join(self, timeout)
+
+    def set_network(self, net, weights=None):
         if not self.config.async_actor:
             self._network = net
+            self._weights = weights
         else:
-            self.__pipe.send([self.NETWORK, net])
+            self.__pipe.send([self.NETWORK, (net, weights)])
+
+
+# A3C style learner. Every process owns its task and optimizer and applies
+# lock-free updates to the network the agent keeps in shared memory.
+class HogwildLearner(mp.Process):
+    def __init__(self, agent):
+        mp.Process.__init__(self, daemon=True)
+        self.agent = agent
+        self.seed = np.random.randint(int(1e9))
+        self.start()
+
+    def run(self):
+        random_seed(self.seed)
+        self.agent.set_up_learner()
+        while True:
+            self.agent.learn()
+
+
+# Runs one batched forward for many actors. Actors write normalized states into
+# shared memory and queue their id, the server batches whatever arrives within
+# max_wait (up to max_batch_size states) and writes the q values back.
+# Close it only after its actors have exited, they block on every reply.
+class InferenceServer(mp.Process):
+    EXIT = -1
+
+    def __init__(self, config, num_clients, rows_per_client=1):
+        mp.Process.__init__(self)
+        # Actors hold the server, so it is pickled with them under spawn/forkserver
+        self.config = config.spec()
+        self.device = Config.DEVICE
+        self.rows_per_client = rows_per_client
+        state_shape = np.asarray(config.eval_env.reset()[0]).shape
+        self.states = torch.zeros((num_clients, rows_per_client) + state_shape).share_memory_()
+        self.q = torch.zeros((num_clients, rows_per_client, config.action_dim)).share_memory_()
+        self.requests = mp.Queue()
+        self.replies = [mp.Semaphore(0) for _ in range(num_clients)]
+        self.network = None
+        self.weights = None
+        self.actor = None
+
+    def serve(self, network, weights, actor):
+        self.network = network if weights is None else copy.deepcopy(network)
+        self.weights = weights
+        self.actor = actor
+        self.start()
+
+    def next_batch(self):
+        clients = [self.requests.get()]
+        deadline = time.time() + self.config.inference_max_wait
+        while (len(clients) + 1) * self.rows_per_client <= self.config.inference_max_batch_size:
+            try:
+                clients.append(self.requests.get(timeout=max(deadline - time.time(), 0)))
+            except queue.Empty:
+                break
+        return clients
+
+    def run(self):
+        Config.DEVICE = self.device
+        # Per-process set up of the actor class, e.g. atoms for C51
+        self.actor._set_up()
+        while True:
+            clients = self.next_batch()
+            exiting = self.EXIT in clients
+            clients = [client for client in clients if client != self.EXIT]
+            if exiting:
+                # Answer whatever is still queued so no client stays blocked on its reply
+                while True:
+                    try:
+                        clients.append(self.requests.get_nowait())
+                    except queue.Empty:
+                        break
+            if clients:
+                self.forward(clients)
+            if exiting:
+                return
+
+    def forward(self, clients):
+        config = self.config
+        if self.weights is not None:
+            self.weights.pull(self.network)
+        if config.noisy_linear:
+            self.network.reset_noise()
+        clients = torch.tensor(clients).long()
+        states = self.states[clients]
+        states = states.view((-1,) + states.size()[2:]).to(Config.DEVICE)
+        if self.weights is not None:
+            prediction = self.network(states)
+        else:
+            with config.lock:
+                prediction = self.network(states)
+        q_values = tensor(self.actor.compute_q(prediction)).cpu()
+        self.q[clients] = q_values.view(len(clients), self.rows_per_client, -1)
+        for client in clients.tolist():
+            self.replies[client].release()
+
+    def q_values(self, client, states):
+        self.states[client].copy_(torch.from_numpy(np.asarray(states, dtype=np.float32)))
+        self.requests.put(client)
+        self.replies[client].acquire()
+        return self.q[client].numpy().copy()
+
+    def close(self):
+        self.requests.put(self.EXIT)
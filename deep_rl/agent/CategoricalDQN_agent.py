@@ -13,8 +13,8 @@ from .DQN_agent import *
 
 
 class CategoricalDQNActor(DQNActor):
-    def __init__(self, config):
-        super().__init__(config)
+    def __init__(self, config, actor_id=0, server=None):
+        super().__init__(config, actor_id, server)
 
     def _set_up(self):
         self.config.atoms = tensor(self.config.atoms)
@@ -33,17 +33,25 @@ class CategoricalDQNAgent(DQNAgent):
                                    config.categorical_v_max, config.categorical_n_atoms)
 
         self.replay = config.replay_fn()
-        self.actor = CategoricalDQNActor(config)
+        self.create_actors(CategoricalDQNActor)
 
         self.network = config.network_fn()
-        self.network.share_memory()
         self.target_network = config.network_fn()
+        self.flat, self.target_flat = None, None
+        if config.flat_parameters:
+            self.flat = FlatParameters(self.network)
+            self.target_flat = FlatParameters(self.target_network, grad=False)
+        self.network.share_memory()
         self.target_network.load_state_dict(self.network.state_dict())
         self.optimizer = config.optimizer_fn(self.network.parameters())
 
-        self.actor.set_network(self.network)
+        self.set_actor_network(self.network)
 
         self.total_steps = 0
+        self.target_updates = 0
+        self.num_updates = 0
+        self.replay_lock = threading.Lock()
+        self.learner = None
         self.batch_indices = range_tensor(config.batch_size)
         self.atoms = tensor(config.atoms)
         self.delta_atom = (config.categorical_v_max - config.categorical_v_min) / float(config.categorical_n_atoms - 1)
@@ -57,15 +65,29 @@ class CategoricalDQNAgent(DQNAgent):
         self.config.state_normalizer.unset_read_only()
         return action
 
+    # Splits the mass of every target atom between its two neighbouring support atoms,
+    # accumulated with index_add_ in O(batch_size * n_atoms)
+    def project(self, atoms_target, prob_next):
+        n_atoms = self.config.categorical_n_atoms
+        b = (atoms_target - self.config.categorical_v_min) / self.delta_atom
+        lower = b.floor().clamp(0, n_atoms - 1)
+        upper_weight = b - lower
+        lower = lower.long()
+        upper = (lower + 1).clamp(max=n_atoms - 1)
+        offset = self.batch_indices.view(-1, 1) * n_atoms
+        target_prob = torch.zeros_like(prob_next)
+        target_prob.view(-1).index_add_(0, (lower + offset).view(-1), (prob_next * (1 - upper_weight)).view(-1))
+        target_prob.view(-1).index_add_(0, (upper + offset).view(-1), (prob_next * upper_weight).view(-1))
+        return target_prob
+
     def compute_loss(self, transitions):
         config = self.config
-        states = self.config.state_normalizer(transitions.state)
-        next_states = self.config.state_normalizer(transitions.next_state)
+        prediction, online_next, target_next = self.predict(transitions)
         with torch.no_grad():
-            prob_next = self.target_network(next_states)['prob']
+            prob_next = target_next['prob']
             q_next = (prob_next * self.atoms).sum(-1)
             if config.double_q:
-                a_next = torch.argmax((self.network(next_states)['prob'] * self.atoms).sum(-1), dim=-1)
+                a_next = torch.argmax((online_next['prob'] * self.atoms).sum(-1), dim=-1)
             else:
                 a_next = torch.argmax(q_next, dim=-1)
             prob_next = prob_next[self.batch_indices, a_next, :]
@@ -74,12 +96,9 @@ class CategoricalDQNAgent(DQNAgent):
         masks = tensor(transitions.mask).unsqueeze(-1)
         atoms_target = rewards + self.config.discount ** config.n_step * masks * self.atoms.view(1, -1)
         atoms_target.clamp_(self.config.categorical_v_min, self.config.categorical_v_max)
-        atoms_target = atoms_target.unsqueeze(1)
-        target_prob = (1 - (atoms_target - self.atoms.view(1, -1, 1)).abs() / self.delta_atom).clamp(0, 1) * \
-                      prob_next.unsqueeze(1)
-        target_prob = target_prob.sum(-1)
+        target_prob = self.project(atoms_target, prob_next)
 
-        log_prob = self.network(states)['log_prob']
+        log_prob = prediction['log_prob']
         actions = tensor(transitions.action).long()
         log_prob = log_prob[self.batch_indices, actions, :]
         KL = (target_prob * target_prob.add(1e-5).log() - target_prob * log_prob).sum(-1)
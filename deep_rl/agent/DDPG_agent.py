@@ -18,12 +18,19 @@ class DDPGAgent(BaseAgent):
         self.network = config.network_fn()
         self.target_network = config.network_fn()
         self.target_network.load_state_dict(self.network.state_dict())
+        self.flat, self.target_flat = None, None
+        if config.flat_parameters:
+            self.flat = FlatParameters(self.network)
+            self.target_flat = FlatParameters(self.target_network, grad=False)
         self.replay = config.replay_fn()
         self.random_process = config.random_process_fn()
         self.total_steps = 0
         self.state = None
 
     def soft_update(self, target, src):
+        if self.flat is not None and target is self.target_network and src is self.network:
+            self.target_flat.lerp_(self.flat, self.config.target_network_mix)
+            return
         for target_param, param in zip(target.parameters(), src.parameters()):
             target_param.detach_()
             target_param.copy_(target_param * (1.0 - self.config.target_network_mix) +
@@ -44,7 +51,9 @@ class DDPGAgent(BaseAgent):
             self.state = config.state_normalizer(self.state)
 
         if self.total_steps < config.warm_up:
-            action = [self.task.action_space.sample()]
+            action_space = self.task.action_space
+            action = np.random.uniform(action_space.low, action_space.high,
+                                       (config.num_workers,) + action_space.shape)
         else:
             action = self.network(self.state)
             action = to_np(action)
@@ -63,39 +72,56 @@ class DDPGAgent(BaseAgent):
             mask=1-np.asarray(done, dtype=np.int32),
         ))
 
-        if done[0]:
-            self.random_process.reset_states()
+        if np.any(done):
+            self.random_process.reset_states(np.nonzero(done)[0])
         self.state = next_state
-        self.total_steps += 1
+        self.total_steps += config.num_workers
 
         if self.replay.size() >= config.warm_up:
+            # One mega-batch of utd_ratio * batch_size, converted once and sliced into utd_ratio updates
             transitions = self.replay.sample()
-            states = tensor(transitions.state)
-            actions = tensor(transitions.action)
-            rewards = tensor(transitions.reward).unsqueeze(-1)
-            next_states = tensor(transitions.next_state)
-            mask = tensor(transitions.mask).unsqueeze(-1)
+            batch = [tensor(transitions.state), tensor(transitions.action), tensor(transitions.reward).unsqueeze(-1),
+                     tensor(transitions.next_state), tensor(transitions.mask).unsqueeze(-1)]
+            batch_size = config.batch_size
+            assert batch[0].size(0) == batch_size * config.utd_ratio, \
+                'replay batch_size should be config.batch_size * config.utd_ratio'
+            for i in range(config.utd_ratio):
+                self.update(*[x[i * batch_size: (i + 1) * batch_size] for x in batch])
+
+    # Gradients are written into the existing .grad tensors, which keeps them views of the flat buffer
+    def set_grad(self, params, grads):
+        for param, grad in zip(params, grads):
+            if param.grad is None:
+                param.grad = grad
+            else:
+                param.grad.copy_(grad)
 
+    def update(self, states, actions, rewards, next_states, mask):
+        config = self.config
+        network = self.network
+        with torch.no_grad():
             phi_next = self.target_network.feature(next_states)
             a_next = self.target_network.actor(phi_next)
             q_next = self.target_network.critic(phi_next, a_next)
             q_next = config.discount * mask * q_next
             q_next.add_(rewards)
-            q_next = q_next.detach()
-            phi = self.network.feature(states)
-            q = self.network.critic(phi, actions)
-            critic_loss = (q - q_next).pow(2).mul(0.5).sum(-1).mean()
 
-            self.network.zero_grad()
-            critic_loss.backward()
-            self.network.critic_opt.step()
+        # The features are computed once and both losses are differentiated before either
+        # optimizer steps, each w.r.t. its own parameters, so no zero_grad is needed
+        phi = network.feature(states)
+        q = network.critic(phi, actions)
+        critic_loss = (q - q_next).pow(2).mul(0.5).sum(-1).mean()
+        action = network.actor(phi)
+        policy_loss = -network.critic(phi.detach(), action).mean()
 
-            phi = self.network.feature(states)
-            action = self.network.actor(phi)
-            policy_loss = -self.network.critic(phi.detach(), action).mean()
+        critic_params = network.critic_params + network.phi_params
+        actor_params = network.actor_params + network.phi_params
+        critic_grads = torch.autograd.grad(critic_loss, critic_params, retain_graph=True)
+        actor_grads = torch.autograd.grad(policy_loss, actor_params)
 
-            self.network.zero_grad()
-            policy_loss.backward()
-            self.network.actor_opt.step()
+        self.set_grad(critic_params, critic_grads)
+        network.critic_opt.step()
+        self.set_grad(actor_params, actor_grads)
+        network.actor_opt.step()
 
-            self.soft_update(self.target_network, self.network)
+        self.soft_update(self.target_network, self.network)
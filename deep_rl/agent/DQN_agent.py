@@ -8,39 +8,116 @@ from ..network import *
 from ..component import *
 from ..utils import *
 import time
+import copy
+from collections import namedtuple
+import threading
 from .BaseAgent import *
 
+# sgd_update_frequency steps of all envs, episodic_return is NaN while an episode runs
+TransitionBatch = namedtuple('TransitionBatch', ['state', 'action', 'reward', 'done', 'episodic_return'])
+
 
 class DQNActor(BaseActor):
-    def __init__(self, config):
+    # Two cached batches, the one being sent, the one the learner reads and the one
+    # sampled right after a STEP request never share a slot
+    NUM_SLOTS = 5
+
+    def __init__(self, config, actor_id=0, server=None):
         BaseActor.__init__(self, config)
-        self.config = config
+        self._actor_id = actor_id
+        self._server = server
+        self._slots = None
+        self._next_slot = 0
         self.start()
 
+    def _sample(self):
+        batch = self.pack(BaseActor._sample(self))
+        if not self.config.async_actor or self.config.actor_backend == 'thread':
+            return batch
+        return self.write_slot(batch)
+
+    def pack(self, transitions):
+        states, actions, rewards, _, dones, infos = zip(*transitions)
+        return TransitionBatch(
+            state=np.asarray([[s[-1] if isinstance(s, LazyFrames) else s for s in state] for state in states]),
+            action=np.asarray(actions),
+            reward=np.asarray(rewards, dtype=np.float32),
+            done=np.asarray(dones, dtype=np.uint8),
+            episodic_return=np.asarray([[np.nan if info_['episodic_return'] is None else info_['episodic_return']
+                                         for info_ in info] for info in infos], dtype=np.float32),
+        )
+
+    # Batches are written into a ring of shared slots, the slots are sent once
+    # and after that only the slot index goes through the pipe
+    def write_slot(self, batch):
+        slots = None
+        if self._slots is None:
+            self._slots = [TransitionBatch(*[torch.from_numpy(np.zeros_like(x)).share_memory_() for x in batch])
+                           for _ in range(self.NUM_SLOTS)]
+            slots = self._slots
+        slot = self._next_slot
+        self._next_slot = (self._next_slot + 1) % self.NUM_SLOTS
+        for buffer, x in zip(self._slots[slot], batch):
+            np.copyto(buffer.numpy(), x)
+        return slot, slots
+
+    def step_wait(self):
+        data = BaseActor.step_wait(self)
+        if isinstance(data, TransitionBatch):
+            return data
+        slot, slots = data
+        if slots is not None:
+            self._slots = slots
+        return TransitionBatch(*[buffer.numpy() for buffer in self._slots[slot]])
+
+    # Ape-X epsilon ladder over the envs of all actors, each env explores with its own fixed epsilon
+    def ladder_epsilon(self):
+        config = self.config
+        num_envs = config.num_actors * config.num_workers
+        if num_envs == 1:
+            return config.apex_epsilon
+        env_ids = self._actor_id * config.num_workers + np.arange(config.num_workers)
+        return config.apex_epsilon ** (1 + config.apex_alpha * env_ids / (num_envs - 1))
+
     def compute_q(self, prediction):
         q_values = to_np(prediction['q'])
         return q_values
 
-    def _transition(self):
-        if self._state is None:
-            self._state = self._task.reset()
+    def local_q_values(self):
         config = self.config
+        if self._weights is not None:
+            self._weights.pull(self._network)
         if config.noisy_linear:
             self._network.reset_noise()
-        with config.lock:
+        if self._weights is not None:
+            # The actor owns its copy of the network, no need to lock
             prediction = self._network(config.state_normalizer(self._state))
-        q_values = self.compute_q(prediction)
+        else:
+            with config.lock:
+                prediction = self._network(config.state_normalizer(self._state))
+        return self.compute_q(prediction)
+
+    def _transition(self):
+        if self._state is None:
+            self._state = self._task.reset()
+        config = self.config
+        if self._server is not None:
+            q_values = self._server.q_values(self._actor_id, config.state_normalizer(self._state))
+        else:
+            q_values = self.local_q_values()
 
         if config.noisy_linear:
             epsilon = 0
         elif self._total_steps < config.exploration_steps:
             epsilon = 1
+        elif config.num_actors > 1 or config.per_env_epsilon:
+            epsilon = self.ladder_epsilon()
         else:
-            epsilon = config.random_action_prob()
+            epsilon = config.random_action_prob(config.num_workers)
         action = epsilon_greedy(epsilon, q_values)
         next_state, reward, done, info = self._task.step(action)
         entry = [self._state, action, reward, next_state, done, info]
-        self._total_steps += 1
+        self._total_steps += config.num_workers
         self._state = next_state
         return entry
 
@@ -52,20 +129,82 @@ class DQNAgent(BaseAgent):
         config.lock = mp.Lock()
 
         self.replay = config.replay_fn()
-        self.actor = DQNActor(config)
+        self.create_actors(DQNActor)
 
         self.network = config.network_fn()
-        self.network.share_memory()
         self.target_network = config.network_fn()
+        self.flat, self.target_flat = None, None
+        if config.flat_parameters:
+            self.flat = FlatParameters(self.network)
+            self.target_flat = FlatParameters(self.target_network, grad=False)
+        self.network.share_memory()
         self.target_network.load_state_dict(self.network.state_dict())
         self.optimizer = config.optimizer_fn(self.network.parameters())
 
-        self.actor.set_network(self.network)
+        self.set_actor_network(self.network)
         self.total_steps = 0
+        self.target_updates = 0
+        self.num_updates = 0
+        self.replay_lock = threading.Lock()
+        self.learner = None
+
+    # The actors and, with config.inference_server, the server doing their forward passes
+    def create_actors(self, actor_cls):
+        config = self.config
+        self.inference_server = None
+        if config.inference_server:
+            self.inference_server = InferenceServer(config, config.num_actors, config.num_workers)
+        self.actors = [actor_cls(config, i, self.inference_server) for i in range(config.num_actors)]
+        self.actor = self.actors[0]
 
     def close(self):
+        self.stop_learner()
         close_obj(self.replay)
-        close_obj(self.actor)
+        for actor in self.actors:
+            close_obj(actor)
+        if self.inference_server is not None:
+            # Prefetching actors only see EXIT once the server has answered their batch
+            for actor in self.actors:
+                actor.join()
+            close_obj(self.inference_server)
+        close_obj(self.config.eval_env)
+
+    # Server backed actors never hold a network, the server keeps the only copy
+    def set_actor_network(self, network):
+        self.weights = None
+        if self.config.versioned_weights:
+            self.weights = VersionedWeights(network)
+        if self.inference_server is not None:
+            self.inference_server.serve(network, self.weights, self.actor)
+        else:
+            for actor in self.actors:
+                if self.weights is None:
+                    actor.set_network(network)
+                else:
+                    actor.set_network(copy.deepcopy(network), self.weights)
+        if len(self.actors) > 1 and self.config.async_actor:
+            for actor in self.actors:
+                actor.step_async()
+        self.next_actor = 0
+
+    # Pairs of (actor index, batch), the index picks the actor's replay segment
+    def collect_transitions(self):
+        if len(self.actors) == 1:
+            return [(0, self.actor.step())]
+        if not self.config.async_actor:
+            return [(i, actor.step()) for i, actor in enumerate(self.actors)]
+        # Take every batch that is ready, block on the actors in turn only if none is
+        batches = []
+        for i, actor in enumerate(self.actors):
+            if actor.poll():
+                batches.append((i, actor.step_wait()))
+                actor.step_async()
+        if not batches:
+            i = self.next_actor
+            self.next_actor = (self.next_actor + 1) % len(self.actors)
+            batches.append((i, self.actors[i].step_wait()))
+            self.actors[i].step_async()
+        return batches
 
     def eval_step(self, state):
         self.config.state_normalizer.set_read_only()
@@ -78,61 +217,192 @@ class DQNAgent(BaseAgent):
     def reduce_loss(self, loss):
         return loss.pow(2).mul(0.5).mean()
 
-    def compute_loss(self, transitions):
+    # Online prediction for states, target (and with double_q online) prediction for next states.
+    # With fused_forward the normalizer runs once over states and next states, and with double_q
+    # the online network does a single forward over both halves, only the state half gets gradients.
+    def predict(self, transitions):
         config = self.config
-        states = self.config.state_normalizer(transitions.state)
-        next_states = self.config.state_normalizer(transitions.next_state)
+        if not config.fused_forward:
+            states = config.state_normalizer(transitions.state)
+            next_states = config.state_normalizer(transitions.next_state)
+            with torch.no_grad():
+                target_next = self.target_network(next_states)
+                online_next = self.network(next_states) if config.double_q else None
+            return self.network(states), online_next, target_next
+
+        batch_size = len(transitions.action)
+        all_states = config.state_normalizer(torch.cat([tensor(transitions.state), tensor(transitions.next_state)]))
         with torch.no_grad():
-            q_next = self.target_network(next_states)['q'].detach()
-            if self.config.double_q:
-                best_actions = torch.argmax(self.network(next_states)['q'], dim=-1)
-                q_next = q_next.gather(1, best_actions.unsqueeze(-1)).squeeze(1)
-            else:
-                q_next = q_next.max(1)[0]
+            target_next = self.target_network(all_states[batch_size:])
+        if config.double_q:
+            prediction = self.network(all_states)
+            online_next = {k: v[batch_size:].detach() for k, v in prediction.items()}
+            prediction = {k: v[:batch_size] for k, v in prediction.items()}
+        else:
+            online_next = None
+            prediction = self.network(all_states[:batch_size])
+        return prediction, online_next, target_next
+
+    def compute_loss(self, transitions):
+        config = self.config
+        prediction, online_next, target_next = self.predict(transitions)
+        q_next = target_next['q']
+        if self.config.double_q:
+            best_actions = torch.argmax(online_next['q'], dim=-1)
+            q_next = q_next.gather(1, best_actions.unsqueeze(-1)).squeeze(1)
+        else:
+            q_next = q_next.max(1)[0]
         masks = tensor(transitions.mask)
         rewards = tensor(transitions.reward)
         q_target = rewards + self.config.discount ** config.n_step * q_next * masks
         actions = tensor(transitions.action).long()
-        q = self.network(states)['q']
+        q = prediction['q']
         q = q.gather(1, actions.unsqueeze(-1)).squeeze(-1)
         loss = q_target - q
         return loss
 
-    def step(self):
+    # One replay feed per actor batch, rows are ordered step by step so the
+    # envs of a step stay together as num_envs strided replay expects. Every actor
+    # writes its own segment (num_segments=num_actors), batches of different actors
+    # would otherwise be stitched into one trajectory.
+    def feed(self, batches):
         config = self.config
-        transitions = self.actor.step()
-        for states, actions, rewards, next_states, dones, info in transitions:
-            self.record_online_return(info)
-            self.total_steps += 1
-            self.replay.feed(dict(
-                state=np.array([s[-1] if isinstance(s, LazyFrames) else s for s in states]),
-                action=actions,
-                reward=[config.reward_normalizer(r) for r in rewards],
-                mask=1 - np.asarray(dones, dtype=np.int32),
-            ))
+        for segment, batch in batches:
+            num_rows = batch.reward.size
+            self.record_online_return(batch.episodic_return.reshape(-1))
+            self.total_steps += num_rows
+            with self.replay_lock:
+                self.replay.feed(dict(
+                    # Copy, the batch may be a view of an actor's shared slot
+                    state=np.array(batch.state.reshape((num_rows,) + batch.state.shape[2:])),
+                    action=batch.action.reshape((num_rows,) + batch.action.shape[2:]),
+                    reward=np.asarray(config.reward_normalizer(batch.reward)).reshape(-1),
+                    mask=1 - batch.done.reshape(-1).astype(np.int32),
+                ), segment)
 
-        if self.total_steps > self.config.exploration_steps:
+    def update(self):
+        config = self.config
+        with self.replay_lock:
             transitions = self.replay.sample()
-            if config.noisy_linear:
-                self.target_network.reset_noise()
-                self.network.reset_noise()
-            loss = self.compute_loss(transitions)
-            if isinstance(transitions, PrioritizedTransition):
-                priorities = loss.abs().add(config.replay_eps).pow(config.replay_alpha)
-                idxs = tensor(transitions.idx).long()
+        if config.noisy_linear:
+            self.target_network.reset_noise()
+            self.network.reset_noise()
+        loss = self.compute_loss(transitions)
+        if isinstance(transitions, PrioritizedTransition):
+            priorities = loss.abs().add(config.replay_eps).pow(config.replay_alpha)
+            idxs = tensor(transitions.idx).long()
+            with self.replay_lock:
                 self.replay.update_priorities(zip(to_np(idxs), to_np(priorities)))
-                sampling_probs = tensor(transitions.sampling_prob)
-                weights = sampling_probs.mul(sampling_probs.size(0)).add(1e-6).pow(-config.replay_beta())
-                weights = weights / weights.max()
-                loss = loss.mul(weights)
+            sampling_probs = tensor(transitions.sampling_prob)
+            weights = sampling_probs.mul(sampling_probs.size(0)).add(1e-6).pow(-config.replay_beta())
+            weights = weights / weights.max()
+            loss = loss.mul(weights)
 
-            loss = self.reduce_loss(loss)
+        loss = self.reduce_loss(loss)
+        if self.flat is not None:
+            self.flat.zero_grad()
+            loss.backward()
+            self.flat.clip_grad_norm_(self.config.gradient_clip)
+        else:
             self.optimizer.zero_grad()
             loss.backward()
             nn.utils.clip_grad_norm_(self.network.parameters(), self.config.gradient_clip)
+        if self.weights is None:
             with config.lock:
                 self.optimizer.step()
+        else:
+            self.optimizer.step()
+        self.num_updates += 1
+        if self.weights is not None and not self.num_updates % config.weight_publish_interval:
+            self.weights.publish(self.network)
+
+    def sync_target(self):
+        config = self.config
+        target_updates = self.total_steps // (config.sgd_update_frequency * config.target_network_update_freq)
+        if target_updates > self.target_updates:
+            self.target_updates = target_updates
+            if self.flat is not None:
+                self.target_flat.copy_(self.flat)
+            else:
+                self.target_network.load_state_dict(self.network.state_dict())
+
+    def step(self):
+        if self.config.decoupled_learner:
+            return self.decoupled_step()
+        self.feed(self.collect_transitions())
+        if self.total_steps > self.config.exploration_steps:
+            self.update()
+        self.sync_target()
+
+    # Gradient updates the learner owes for the env steps so far
+    def update_budget(self):
+        config = self.config
+        replay_ratio = config.replay_ratio
+        if replay_ratio is None:
+            replay_ratio = 1.0 / config.sgd_update_frequency
+        if self.total_steps <= config.exploration_steps:
+            return 0
+        return int((self.total_steps - config.exploration_steps) * replay_ratio)
+
+    def start_learner(self):
+        self.learner_cond = threading.Condition()
+        self.learner_stopped = False
+        self.learner_error = None
+        # Held for every update, eval and save hold it to pause the learner
+        self.update_lock = threading.Lock()
+        self.learner = threading.Thread(target=self.learn, daemon=True)
+        self.learner.start()
+
+    def stop_learner(self):
+        if self.learner is None:
+            return
+        with self.learner_cond:
+            self.learner_stopped = True
+            self.learner_cond.notify_all()
+        self.learner.join()
+
+    # The learner runs until it has used up the update budget and then waits for
+    # more env steps, the actors wait whenever it lags by more than max_update_lag
+    def learn(self):
+        while True:
+            with self.learner_cond:
+                while not self.learner_stopped and self.num_updates >= self.update_budget():
+                    self.learner_cond.wait()
+                if self.learner_stopped:
+                    return
+            try:
+                with self.update_lock:
+                    self.update()
+                    self.sync_target()
+            except Exception as e:
+                # Raised again by decoupled_step in the main thread
+                with self.learner_cond:
+                    self.learner_error = e
+                    self.learner_cond.notify_all()
+                return
+            with self.learner_cond:
+                self.learner_cond.notify_all()
+
+    def eval_episodes(self):
+        if self.learner is None:
+            return BaseAgent.eval_episodes(self)
+        with self.update_lock:
+            return BaseAgent.eval_episodes(self)
+
+    def save(self, filename):
+        if self.learner is None:
+            return BaseAgent.save(self, filename)
+        with self.update_lock:
+            return BaseAgent.save(self, filename)
 
-        if self.total_steps / self.config.sgd_update_frequency % \
-                self.config.target_network_update_freq == 0:
-            self.target_network.load_state_dict(self.network.state_dict())
+    def decoupled_step(self):
+        if self.learner is None:
+            self.start_learner()
+        self.feed(self.collect_transitions())
+        with self.learner_cond:
+            self.learner_cond.notify_all()
+            while self.learner_error is None and \
+                    self.update_budget() - self.num_updates > self.config.max_update_lag:
+                self.learner_cond.wait()
+            if self.learner_error is not None:
+                raise self.learner_error
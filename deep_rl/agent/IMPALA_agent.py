@@ -0,0 +1,139 @@
+#######################################################################
+# Copyright (C) 2017 Shangtong Zhang(zhangshangtong.cpp@gmail.com)    #
+# Permission given to modify the code as long as you keep this        #
+# declaration at the top                                              #
+#######################################################################
+
+from ..network import *
+from ..component import *
+from .BaseAgent import *
+
+
+class IMPALAActor(BaseActor):
+    def __init__(self, config):
+        BaseActor.__init__(self, config)
+        self.start()
+
+    # One rollout of rollout_length steps for each of the num_workers envs,
+    # generated with the weights published when the rollout starts
+    def _sample(self):
+        config = self.config
+        if self._state is None:
+            self._state = self._task.reset()
+        self._weights.pull(self._network)
+        storage = Storage(config.rollout_length)
+        infos = []
+        states = self._state
+        for _ in range(config.rollout_length):
+            with torch.no_grad():
+                prediction = self._network(config.state_normalizer(states))
+            next_states, rewards, terminals, info = self._task.step(to_np(prediction['action']))
+            infos.append(info)
+            storage.feed({'state': np.asarray(states),
+                          'action': to_np(prediction['action']),
+                          'log_pi_a': to_np(prediction['log_pi_a']),
+                          'reward': np.asarray(config.reward_normalizer(rewards), dtype=np.float32)[:, None],
+                          'mask': (1 - np.asarray(terminals, dtype=np.float32))[:, None]})
+            states = next_states
+            self._total_steps += config.num_workers
+        self._state = states
+        storage.feed({'state': np.asarray(states)})
+        rollout = {k: np.stack(getattr(storage, k)) for k in ['state', 'action', 'log_pi_a', 'reward', 'mask']}
+        rollout['info'] = infos
+        return rollout
+
+
+class IMPALAAgent(BaseAgent):
+    def __init__(self, config):
+        BaseAgent.__init__(self, config)
+        self.config = config
+        self.actors = [IMPALAActor(config) for _ in range(config.num_actors)]
+        self.network = config.network_fn()
+        self.optimizer = config.optimizer_fn(self.network.parameters())
+        self.weights = VersionedWeights(self.network)
+        for actor in self.actors:
+            actor.set_network(copy.deepcopy(self.network), self.weights)
+            if config.async_actor:
+                actor.step_async()
+        self.next_actor = 0
+        self.total_steps = 0
+
+    def close(self):
+        for actor in self.actors:
+            close_obj(actor)
+        close_obj(self.config.eval_env)
+
+    def eval_step(self, state):
+        self.config.state_normalizer.set_read_only()
+        state = self.config.state_normalizer(state)
+        action = to_np(self.network(state)['action'])
+        self.config.state_normalizer.unset_read_only()
+        return action
+
+    # Take ready rollouts first, block on the actors in turn only if none is
+    def collect_rollouts(self):
+        rollouts = []
+        while len(rollouts) < self.config.rollout_batch_size:
+            if not self.config.async_actor:
+                ready = [self.actors[self.next_actor]]
+            else:
+                ready = [actor for actor in self.actors if actor.poll()]
+                if not ready:
+                    ready = [self.actors[self.next_actor]]
+            self.next_actor = (self.next_actor + 1) % len(self.actors)
+            for actor in ready[:self.config.rollout_batch_size - len(rollouts)]:
+                if self.config.async_actor:
+                    rollouts.append(actor.step_wait())
+                    actor.step_async()
+                else:
+                    rollouts.append(actor.step())
+        return rollouts
+
+    # V-trace targets and policy advantages, gae_tau plays the role of lambda
+    def vtrace(self, log_pi_a, log_mu_a, values, rewards, masks):
+        config = self.config
+        rhos = (log_pi_a - log_mu_a).exp()
+        clipped_rhos = rhos.clamp(max=config.vtrace_rho_clip)
+        cs = rhos.clamp(max=config.vtrace_c_clip) * (config.gae_tau if config.use_gae else 1)
+        vs = values.clone()
+        advantages = torch.zeros_like(rewards)
+        for i in reversed(range(rewards.size(0))):
+            td_error = clipped_rhos[i] * (rewards[i] + config.discount * masks[i] * values[i + 1] - values[i])
+            vs[i] = values[i] + td_error + config.discount * masks[i] * cs[i] * (vs[i + 1] - values[i + 1])
+            advantages[i] = clipped_rhos[i] * (rewards[i] + config.discount * masks[i] * vs[i + 1] - values[i])
+        return vs[:-1], advantages
+
+    def step(self):
+        config = self.config
+        rollouts = self.collect_rollouts()
+        for rollout in rollouts:
+            for info in rollout['info']:
+                self.record_online_return(info)
+                self.total_steps += config.num_workers
+
+        # Rollouts are batched along the env axis
+        batch = {k: np.concatenate([rollout[k] for rollout in rollouts], axis=1)
+                 for k in ['state', 'action', 'log_pi_a', 'reward', 'mask']}
+        T, B = batch['action'].shape[:2]
+        states = config.state_normalizer(batch['state'].reshape((-1,) + batch['state'].shape[2:]))
+        actions = torch.from_numpy(batch['action']).to(Config.DEVICE)
+        prediction = self.network(states[:T * B], actions.view((T * B,) + actions.size()[2:]))
+        log_pi_a = prediction['log_pi_a'].view(T, B, 1)
+        v = prediction['v'].view(T, B, 1)
+        entropy = prediction['entropy'].view(T, B, -1)
+        with torch.no_grad():
+            next_v = self.network(states[T * B:])['v']
+            values = torch.cat([v.detach(), next_v.unsqueeze(0)], dim=0)
+            vs, advantages = self.vtrace(log_pi_a.detach(), tensor(batch['log_pi_a']), values,
+                                         tensor(batch['reward']), tensor(batch['mask']))
+
+        policy_loss = -(log_pi_a * advantages).mean()
+        value_loss = 0.5 * (vs - v).pow(2).mean()
+        entropy_loss = entropy.mean()
+
+        self.optimizer.zero_grad()
+        (policy_loss - config.entropy_weight * entropy_loss +
+         config.value_loss_weight * value_loss).backward()
+        nn.utils.clip_grad_norm_(self.network.parameters(), config.gradient_clip)
+        self.optimizer.step()
+        self.weights.publish(self.network)
@@ -14,16 +14,33 @@ class NStepDQNAgent(BaseAgent):
     def __init__(self, config):
         BaseAgent.__init__(self, config)
         self.config = config
-        self.task = config.task_fn()
+        self.task = None
         self.network = config.network_fn()
         self.target_network = config.network_fn()
-        self.optimizer = config.optimizer_fn(self.network.parameters())
         self.target_network.load_state_dict(self.network.state_dict())
 
         self.total_steps = 0
+        # Steps of all learners, the target syncs every target_network_update_freq of them
+        self.learner_steps = mp.Value('l', 0)
+        if config.num_learners > 1:
+            self.target_network.share_memory()
+            self.start_learners()
+        else:
+            self.set_up_learner()
+
+    def set_up_learner(self):
+        config = self.config
+        self.task = config.task_fn()
+        self.optimizer = config.optimizer_fn(self.network.parameters())
         self.states = self.task.reset()
 
     def step(self):
+        if self.learners:
+            self.hogwild_step()
+        else:
+            self.learn()
+
+    def learn(self):
         config = self.config
         storage = Storage(config.rollout_length)
 
@@ -35,7 +52,7 @@ class NStepDQNAgent(BaseAgent):
             actions = epsilon_greedy(epsilon, to_np(q))
 
             next_states, rewards, terminals, info = self.task.step(actions)
-            self.record_online_return(info)
+            self.track_env_step(info)
             rewards = config.reward_normalizer(rewards)
 
             storage.feed({'q': q,
@@ -45,8 +62,10 @@ class NStepDQNAgent(BaseAgent):
 
             states = next_states
 
-            self.total_steps += config.num_workers
-            if self.total_steps // config.num_workers % config.target_network_update_freq == 0:
+            with self.learner_steps.get_lock():
+                self.learner_steps.value += 1
+                sync_target = self.learner_steps.value % config.target_network_update_freq == 0
+            if sync_target:
                 self.target_network.load_state_dict(self.network.state_dict())
 
         self.states = states
@@ -12,8 +12,8 @@ from .DQN_agent import *
 
 
 class QuantileRegressionDQNActor(DQNActor):
-    def __init__(self, config):
-        super().__init__(config)
+    def __init__(self, config, actor_id=0, server=None):
+        super().__init__(config, actor_id, server)
 
     def compute_q(self, prediction):
         q_values = prediction['quantile'].mean(-1)
@@ -27,17 +27,25 @@ class QuantileRegressionDQNAgent(DQNAgent):
         config.lock = mp.Lock()
 
         self.replay = config.replay_fn()
-        self.actor = QuantileRegressionDQNActor(config)
+        self.create_actors(QuantileRegressionDQNActor)
 
         self.network = config.network_fn()
-        self.network.share_memory()
         self.target_network = config.network_fn()
+        self.flat, self.target_flat = None, None
+        if config.flat_parameters:
+            self.flat = FlatParameters(self.network)
+            self.target_flat = FlatParameters(self.target_network, grad=False)
+        self.network.share_memory()
         self.target_network.load_state_dict(self.network.state_dict())
         self.optimizer = config.optimizer_fn(self.network.parameters())
 
-        self.actor.set_network(self.network)
+        self.set_actor_network(self.network)
 
         self.total_steps = 0
+        self.target_updates = 0
+        self.num_updates = 0
+        self.replay_lock = threading.Lock()
+        self.learner = None
         self.batch_indices = range_tensor(config.batch_size)
 
         self.quantile_weight = 1.0 / self.config.num_quantiles
@@ -53,10 +61,8 @@ class QuantileRegressionDQNAgent(DQNAgent):
         return [action]
 
     def compute_loss(self, transitions):
-        states = self.config.state_normalizer(transitions.state)
-        next_states = self.config.state_normalizer(transitions.next_state)
-
-        quantiles_next = self.target_network(next_states)['quantile'].detach()
+        prediction, _, target_next = self.predict(transitions)
+        quantiles_next = target_next['quantile'].detach()
         a_next = torch.argmax(quantiles_next.sum(-1), dim=-1)
         quantiles_next = quantiles_next[self.batch_indices, a_next, :]
 
@@ -64,14 +70,11 @@ class QuantileRegressionDQNAgent(DQNAgent):
         masks = tensor(transitions.mask).unsqueeze(-1)
         quantiles_next = rewards + self.config.discount ** self.config.n_step * masks * quantiles_next
 
-        quantiles = self.network(states)['quantile']
+        quantiles = prediction['quantile']
         actions = tensor(transitions.action).long()
         quantiles = quantiles[self.batch_indices, actions, :]
 
-        quantiles_next = quantiles_next.t().unsqueeze(-1)
-        diff = quantiles_next - quantiles
-        loss = huber(diff) * (self.cumulative_density - (diff.detach() < 0).float()).abs()
-        return loss.sum(-1).mean(1)
+        return quantile_huber_loss(quantiles, quantiles_next, self.cumulative_density)
 
     def reduce_loss(self, loss):
         return loss.mean()
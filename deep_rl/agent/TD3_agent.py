@@ -18,17 +18,31 @@ class TD3Agent(BaseAgent):
         self.network = config.network_fn()
         self.target_network = config.network_fn()
         self.target_network.load_state_dict(self.network.state_dict())
+        self.flat, self.target_flat = None, None
+        if config.flat_parameters:
+            self.flat = FlatParameters(self.network)
+            self.target_flat = FlatParameters(self.target_network, grad=False)
         self.replay = config.replay_fn()
         self.random_process = config.random_process_fn()
         self.total_steps = 0
+        self.num_updates = 0
         self.state = None
 
     def soft_update(self, target, src):
+        if self.flat is not None and target is self.target_network and src is self.network:
+            self.target_flat.lerp_(self.flat, self.config.target_network_mix)
+            return
         for target_param, param in zip(target.parameters(), src.parameters()):
             target_param.detach_()
             target_param.copy_(target_param * (1.0 - self.config.target_network_mix) +
                                param * self.config.target_network_mix)
 
+    def zero_grad(self):
+        if self.flat is not None:
+            self.flat.zero_grad()
+        else:
+            self.network.zero_grad()
+
     def eval_step(self, state):
         self.config.state_normalizer.set_read_only()
         state = self.config.state_normalizer(state)
@@ -44,7 +58,9 @@ class TD3Agent(BaseAgent):
             self.state = config.state_normalizer(self.state)
 
         if self.total_steps < config.warm_up:
-            action = [self.task.action_space.sample()]
+            action_space = self.task.action_space
+            action = np.random.uniform(action_space.low, action_space.high,
+                                       (config.num_workers,) + action_space.shape)
         else:
             action = self.network(self.state)
             action = to_np(action)
@@ -63,44 +79,52 @@ class TD3Agent(BaseAgent):
             mask=1-np.asarray(done, dtype=np.int32),
         ))
 
-        if done[0]:
-            self.random_process.reset_states()
+        if np.any(done):
+            self.random_process.reset_states(np.nonzero(done)[0])
         self.state = next_state
-        self.total_steps += 1
+        self.total_steps += config.num_workers
 
         if self.total_steps >= config.warm_up:
+            # One mega-batch of utd_ratio * batch_size, converted once and sliced into utd_ratio updates
             transitions = self.replay.sample()
-            states = tensor(transitions.state)
-            actions = tensor(transitions.action)
-            rewards = tensor(transitions.reward).unsqueeze(-1)
-            next_states = tensor(transitions.next_state)
-            mask = tensor(transitions.mask).unsqueeze(-1)
-
-            a_next = self.target_network(next_states)
-            noise = torch.randn_like(a_next).mul(config.td3_noise)
-            noise = noise.clamp(-config.td3_noise_clip, config.td3_noise_clip)
+            batch = [tensor(transitions.state), tensor(transitions.action), tensor(transitions.reward).unsqueeze(-1),
+                     tensor(transitions.next_state), tensor(transitions.mask).unsqueeze(-1)]
+            batch_size = config.batch_size
+            assert batch[0].size(0) == batch_size * config.utd_ratio, \
+                'replay batch_size should be config.batch_size * config.utd_ratio'
+            for i in range(config.utd_ratio):
+                self.update(*[x[i * batch_size: (i + 1) * batch_size] for x in batch])
+
+    def update(self, states, actions, rewards, next_states, mask):
+        config = self.config
+        a_next = self.target_network(next_states)
+        noise = torch.randn_like(a_next).mul(config.td3_noise)
+        noise = noise.clamp(-config.td3_noise_clip, config.td3_noise_clip)
 
-            min_a = float(self.task.action_space.low[0])
-            max_a = float(self.task.action_space.high[0])
-            a_next = (a_next + noise).clamp(min_a, max_a)
+        min_a = float(self.task.action_space.low[0])
+        max_a = float(self.task.action_space.high[0])
+        a_next = (a_next + noise).clamp(min_a, max_a)
 
-            q_1, q_2 = self.target_network.q(next_states, a_next)
-            target = rewards + config.discount * mask * torch.min(q_1, q_2)
-            target = target.detach()
+        q_next = self.target_network.q_all(next_states, a_next).min(0)[0]
+        target = rewards + config.discount * mask * q_next
+        target = target.detach()
 
-            q_1, q_2 = self.network.q(states, actions)
-            critic_loss = F.mse_loss(q_1, target) + F.mse_loss(q_2, target)
+        # Sum of the mean squared errors of all critics
+        q = self.network.q_all(states, actions)
+        critic_loss = (q - target).pow(2).mean((1, 2)).sum()
 
-            self.network.zero_grad()
-            critic_loss.backward()
-            self.network.critic_opt.step()
+        self.zero_grad()
+        critic_loss.backward()
+        self.network.critic_opt.step()
 
-            if self.total_steps % config.td3_delay:
-                action = self.network(states)
-                policy_loss = -self.network.q(states, action)[0].mean()
+        # Counted in updates, total_steps moves by num_workers per step
+        self.num_updates += 1
+        if not self.num_updates % config.td3_delay:
+            action = self.network(states)
+            policy_loss = -self.network.q(states, action)[0].mean()
 
-                self.network.zero_grad()
-                policy_loss.backward()
-                self.network.actor_opt.step()
+            self.zero_grad()
+            policy_loss.backward()
+            self.network.actor_opt.step()
 
-                self.soft_update(self.target_network, self.network)
+            self.soft_update(self.target_network, self.network)
@@ -1,6 +1,7 @@
 from .DQN_agent import *
 from .DDPG_agent import *
 from .A2C_agent import *
+from .IMPALA_agent import *
 from .CategoricalDQN_agent import *
 from .NStepDQN_agent import *
 from .QuantileRegressionDQN_agent import *
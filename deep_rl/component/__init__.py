@@ -2,3 +2,4 @@ from .replay import *
 from .random_process import *
 from .envs import Task
 from .envs import LazyFrames
+from .envs import EnvPool
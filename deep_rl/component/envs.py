@@ -6,8 +6,14 @@
 
 import os
 import gym
+import json
+import socket
+import struct
+import queue
 import numpy as np
 import torch
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
 from gym.spaces.box import Box
 from gym.spaces.discrete import Discrete
 
@@ -28,9 +34,8 @@ def make_env(env_id, seed, rank, episode_life=True):
     def _thunk():
         random_seed(seed)
         if env_id.startswith("dm"):
-            import dm_control2gym
             _, domain, task = env_id.split('-')
-            env = dm_control2gym.make(domain_name=domain, task_name=task)
+            env = DMControlEnv(domain, task)
         else:
             env = gym.make(env_id)
         is_atari = hasattr(gym.envs, 'atari') and isinstance(
@@ -55,6 +60,55 @@ def make_env(env_id, seed, rank, episode_life=True):
     return _thunk
 
 
+def make_async_reset_env(env_fn, standby_fn):
+    def _thunk():
+        return AsyncResetEnv(env_fn, standby_fn)
+
+    return _thunk
+
+
+class DMControlEnv(gym.Env):
+    def __init__(self, domain_name, task_name):
+        from dm_control import suite
+        self.env = suite.load(domain_name=domain_name, task_name=task_name)
+
+        # Layout of the flat observation, computed once from the spec
+        slices = []
+        offset = 0
+        for key, spec in self.env.observation_spec().items():
+            size = int(np.prod(spec.shape))
+            slices.append((key, offset, offset + size, spec.shape))
+            offset += size
+        self.obs = np.zeros(offset, dtype=np.float32)
+        self.obs_views = [(key, self.obs[start:end].reshape(shape)) for key, start, end, shape in slices]
+        self.observation_space = Box(-np.inf, np.inf, (offset,), dtype=np.float32)
+
+        action_spec = self.env.action_spec()
+        self.action_scale = (action_spec.maximum - action_spec.minimum) / 2.0
+        self.action_offset = (action_spec.maximum + action_spec.minimum) / 2.0
+        self.action_space = Box(-1.0, 1.0, action_spec.shape, dtype=np.float32)
+
+    def flatten_observation(self, observation):
+        for key, view in self.obs_views:
+            np.copyto(view, observation[key], casting='unsafe')
+        # Agents keep references to observations, so hand out a copy of the buffer
+        return self.obs.copy()
+
+    def seed(self, seed=None):
+        self.env.task.random.seed(seed)
+
+    def step(self, action):
+        action = self.action_offset + self.action_scale * np.clip(action, -1, 1)
+        time_step = self.env.step(action)
+        return self.flatten_observation(time_step.observation), time_step.reward or 0.0, time_step.last(), {}
+
+    def reset(self):
+        return self.flatten_observation(self.env.reset().observation)
+
+    def render(self, mode='rgb_array', height=480, width=480, camera_id=0):
+        return self.env.physics.render(height=height, width=width, camera_id=camera_id)
+
+
 class OriginalReturnWrapper(gym.Wrapper):
     def __init__(self, env):
         gym.Wrapper.__init__(self, env)
@@ -71,6 +125,7 @@ class OriginalReturnWrapper(gym.Wrapper):
         return obs, reward, done, info
 
     def reset(self):
+        self.total_rewards = 0
         return self.env.reset()
 
 
@@ -88,6 +143,38 @@ class TransposeImage(gym.ObservationWrapper):
         return observation.transpose(2, 0, 1)
 
 
+# Keeps a standby copy of the env that is reset in a background thread,
+# so a finished episode is replaced without waiting for a full reset.
+# Only real episode ends (as reported by OriginalReturnWrapper) swap envs,
+# life losses under episode_life still reset the running env in place.
+class AsyncResetEnv(gym.Wrapper):
+    def __init__(self, env_fn, standby_fn):
+        gym.Wrapper.__init__(self, env_fn())
+        self.standby = standby_fn()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.standby_obs = self.executor.submit(self.standby.reset)
+        self.episode_over = False
+
+    def step(self, action):
+        obs, reward, done, info = self.env.step(action)
+        self.episode_over = done and info['episodic_return'] is not None
+        return obs, reward, done, info
+
+    def reset(self):
+        if not self.episode_over:
+            return self.env.reset()
+        self.episode_over = False
+        obs = self.standby_obs.result()
+        self.env, self.standby = self.standby, self.env
+        self.standby_obs = self.executor.submit(self.standby.reset)
+        return obs
+
+    def close(self):
+        self.executor.shutdown()
+        self.standby.close()
+        return self.env.close()
+
+
 # The original LayzeFrames doesn't work well
 class LazyFrames(object):
     def __init__(self, frames):
@@ -150,6 +237,309 @@ class DummyVecEnv(VecEnv):
         return
 
 
+# Starts a new game through the whole wrapper stack. EpisodicLifeEnv only does a no-op
+# step on reset after a lost life, which would skip the resets of the wrappers below it.
+def reset_episode(env):
+    wrapper = env
+    while True:
+        if hasattr(wrapper, 'was_real_done'):
+            wrapper.was_real_done = True
+        if not isinstance(wrapper, gym.Wrapper):
+            break
+        wrapper = wrapper.env
+    return env.reset()
+
+
+def pool_worker(remote, parent_remote):
+    parent_remote.close()
+    env = None
+    env_id = None
+    while True:
+        cmd, data = remote.recv()
+        if cmd == 'step':
+            obs, reward, done, info = env.step(data)
+            if done:
+                obs = env.reset()
+            remote.send((obs, reward, done, info))
+        elif cmd == 'reset':
+            remote.send(env.reset())
+        elif cmd == 'make':
+            name, seed, rank, episode_life = data
+            if env_id == (name, episode_life):
+                # Same env, reseed it and start a new game, skipping process start-up,
+                # imports and ROM loading
+                random_seed(seed)
+                env.seed(seed + rank)
+                reset_episode(env)
+            else:
+                close_obj(env)
+                env = make_env(name, seed, rank, episode_life)()
+                env_id = (name, episode_life)
+            remote.send((env.observation_space, env.action_space))
+        elif cmd == 'close':
+            close_obj(env)
+            remote.close()
+            return
+        else:
+            raise NotImplementedError
+
+
+# Worker processes that stay alive across tasks and runs,
+# num_workers should cover all envs leased at the same time
+class EnvPool:
+    def __init__(self, num_workers):
+        self.remotes, work_remotes = zip(*[mp.Pipe() for _ in range(num_workers)])
+        self.ps = [mp.Process(target=pool_worker, args=(work_remote, remote), daemon=True)
+                   for work_remote, remote in zip(work_remotes, self.remotes)]
+        for p in self.ps:
+            p.start()
+        for work_remote in work_remotes:
+            work_remote.close()
+        self.free_workers = mp.Queue()
+        for i in range(num_workers):
+            self.free_workers.put(i)
+
+    # Fails instead of waiting when the free workers cannot cover num_envs,
+    # typically a task that was never closed still holds its workers
+    def lease(self, name, seed, num_envs, episode_life=True):
+        worker_ids = []
+        try:
+            for _ in range(num_envs):
+                worker_ids.append(self.free_workers.get(timeout=1))
+        except queue.Empty:
+            self.release(worker_ids)
+            raise RuntimeError('EnvPool cannot lease %d workers, %d are free' % (num_envs, len(worker_ids)))
+        return PooledVecEnv(self, worker_ids, name, seed, episode_life)
+
+    def release(self, worker_ids):
+        for i in worker_ids:
+            self.free_workers.put(i)
+
+    def close(self):
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for p in self.ps:
+            p.join()
+
+
+class PooledVecEnv(VecEnv):
+    def __init__(self, pool, worker_ids, name, seed, episode_life):
+        self.pool = pool
+        self.worker_ids = worker_ids
+        self.remotes = [pool.remotes[i] for i in worker_ids]
+        for rank, remote in enumerate(self.remotes):
+            remote.send(('make', (name, seed, rank, episode_life)))
+        observation_space, action_space = [remote.recv() for remote in self.remotes][0]
+        VecEnv.__init__(self, len(worker_ids), observation_space, action_space)
+
+    def step_async(self, actions):
+        for remote, action in zip(self.remotes, actions):
+            remote.send(('step', action))
+
+    def step_wait(self):
+        obs, rew, done, info = zip(*[remote.recv() for remote in self.remotes])
+        return obs, np.asarray(rew), np.asarray(done), info
+
+    def reset(self):
+        for remote in self.remotes:
+            remote.send(('reset', None))
+        return [remote.recv() for remote in self.remotes]
+
+    def close(self):
+        if self.remotes:
+            self.pool.release(self.worker_ids)
+            self.remotes = []
+
+
+# Binary step/reset protocol for remote env workers. Every message is a
+# (op, payload length) header followed by the payload. Handshakes are json,
+# observations, actions, rewards, dones and returns are raw arrays.
+class RemoteEnvProtocol:
+    MAKE = 0
+    RESET = 1
+    STEP = 2
+    CLOSE = 3
+    HEADER = struct.Struct('!BI')
+
+    @classmethod
+    def send(cls, sock, op, *payloads):
+        payloads = [memoryview(p).cast('B') for p in payloads]
+        sock.sendall(cls.HEADER.pack(op, sum(len(p) for p in payloads)))
+        for p in payloads:
+            sock.sendall(p)
+
+    @classmethod
+    def recv(cls, sock):
+        op, size = cls.HEADER.unpack(cls.recv_exactly(sock, cls.HEADER.size))
+        return op, cls.recv_exactly(sock, size)
+
+    @staticmethod
+    def recv_exactly(sock, size):
+        buf = bytearray(size)
+        view = memoryview(buf)
+        while size:
+            n = sock.recv_into(view, size)
+            if not n:
+                raise ConnectionError('Remote env connection closed')
+            view = view[n:]
+            size -= n
+        return buf
+
+    @staticmethod
+    def obs_dtype_for(observation_space):
+        if np.issubdtype(observation_space.dtype, np.floating):
+            return np.dtype(np.float32)
+        return np.dtype(observation_space.dtype)
+
+    @staticmethod
+    def action_dtype_for(action_space):
+        if isinstance(action_space, Discrete):
+            return np.dtype(np.int64)
+        return np.dtype(np.float32)
+
+
+# Hosts a slice of envs for one learner at a time, e.g.
+# RemoteEnvServer('0.0.0.0', 6000).serve_forever()
+class RemoteEnvServer(RemoteEnvProtocol):
+    def __init__(self, host, port):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(1)
+
+    def serve_forever(self):
+        while True:
+            conn, _ = self.sock.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            try:
+                self.serve(conn)
+            except ConnectionError:
+                pass
+            finally:
+                conn.close()
+
+    def serve(self, conn):
+        env = None
+        while True:
+            op, payload = self.recv(conn)
+            if op == self.MAKE:
+                close_obj(env)
+                spec = json.loads(payload.decode())
+                env = DummyVecEnv([make_env(spec['name'], spec['seed'], spec['rank'] + i, spec['episode_life'])
+                                   for i in range(spec['num_envs'])])
+                obs_dtype = self.obs_dtype_for(env.observation_space)
+                action_dtype = self.action_dtype_for(env.action_space)
+                obs = env.reset()
+                frame_stack = len(obs[0]._frames) if isinstance(obs[0], LazyFrames) else 0
+                # FrameStack reports a channel-last space, so ship the real observation shape
+                reply = dict(observation_space=self.space_spec(env.observation_space),
+                             action_space=self.space_spec(env.action_space),
+                             obs_shape=np.asarray(obs[0]).shape,
+                             frame_stack=frame_stack)
+                self.send(conn, op, json.dumps(reply).encode())
+            elif op == self.RESET:
+                obs = env.reset()
+                self.send(conn, op, self.encode_obs(obs, obs_dtype))
+            elif op == self.STEP:
+                actions = np.frombuffer(payload, dtype=action_dtype).reshape((env.num_envs,) + env.action_space.shape)
+                obs, rewards, dones, infos = env.step(actions)
+                returns = np.asarray([np.nan if info['episodic_return'] is None else info['episodic_return']
+                                      for info in infos], dtype=np.float32)
+                self.send(conn, op, self.encode_obs(obs, obs_dtype), rewards.astype(np.float32),
+                          dones.astype(np.uint8), returns)
+            elif op == self.CLOSE:
+                close_obj(env)
+                return
+            else:
+                raise NotImplementedError
+
+    @staticmethod
+    def encode_obs(obs, dtype):
+        return np.ascontiguousarray(np.stack([np.asarray(o) for o in obs]), dtype=dtype)
+
+    @staticmethod
+    def space_spec(space):
+        if isinstance(space, Discrete):
+            return dict(n=int(space.n))
+        return dict(low=space.low.tolist(), high=space.high.tolist(), dtype=str(space.dtype))
+
+
+class RemoteVecEnv(VecEnv, RemoteEnvProtocol):
+    def __init__(self, addresses, name, seed, num_envs, episode_life):
+        slices = [list(s) for s in split(range(num_envs), len(addresses))]
+        self.socks = []
+        self.envs_per_sock = []
+        for address, ranks in zip(addresses, slices):
+            if not len(ranks):
+                continue
+            host, port = address.rsplit(':', 1)
+            sock = socket.create_connection((host, int(port)))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            spec = dict(name=name, seed=seed, rank=ranks[0], num_envs=len(ranks), episode_life=episode_life)
+            self.send(sock, self.MAKE, json.dumps(spec).encode())
+            self.socks.append(sock)
+            self.envs_per_sock.append(len(ranks))
+        for sock in self.socks:
+            _, payload = self.recv(sock)
+            spec = json.loads(payload.decode())
+
+        observation_space = self.parse_space(spec['observation_space'])
+        action_space = self.parse_space(spec['action_space'])
+        self.obs_shape = tuple(spec['obs_shape'])
+        self.frame_stack = spec['frame_stack']
+        self.obs_dtype = self.obs_dtype_for(observation_space)
+        self.action_dtype = self.action_dtype_for(action_space)
+        VecEnv.__init__(self, num_envs, observation_space, action_space)
+        self.actions = None
+
+    @staticmethod
+    def parse_space(spec):
+        if 'n' in spec:
+            return Discrete(spec['n'])
+        return Box(np.asarray(spec['low']), np.asarray(spec['high']), dtype=np.dtype(spec['dtype']))
+
+    def decode_obs(self, payload, num_envs):
+        obs = np.frombuffer(payload, dtype=self.obs_dtype, count=num_envs * int(np.prod(self.obs_shape)))
+        obs = obs.reshape((num_envs,) + self.obs_shape)
+        if self.frame_stack:
+            return [LazyFrames(np.split(o, self.frame_stack)) for o in obs]
+        return list(obs)
+
+    def step_async(self, actions):
+        self.actions = np.ascontiguousarray(actions, dtype=self.action_dtype)
+        start = 0
+        for sock, n in zip(self.socks, self.envs_per_sock):
+            self.send(sock, self.STEP, self.actions[start: start + n])
+            start += n
+
+    def step_wait(self):
+        obs, rewards, dones, returns = [], [], [], []
+        for sock, n in zip(self.socks, self.envs_per_sock):
+            _, payload = self.recv(sock)
+            obs.extend(self.decode_obs(payload, n))
+            offset = n * int(np.prod(self.obs_shape)) * self.obs_dtype.itemsize
+            rewards.append(np.frombuffer(payload, dtype=np.float32, count=n, offset=offset))
+            dones.append(np.frombuffer(payload, dtype=np.uint8, count=n, offset=offset + 4 * n))
+            returns.append(np.frombuffer(payload, dtype=np.float32, count=n, offset=offset + 5 * n))
+        infos = tuple({'episodic_return': None if np.isnan(ret) else float(ret)} for ret in np.concatenate(returns))
+        return tuple(obs), np.concatenate(rewards), np.concatenate(dones).astype(np.bool_), infos
+
+    def reset(self):
+        for sock in self.socks:
+            self.send(sock, self.RESET)
+        obs = []
+        for sock, n in zip(self.socks, self.envs_per_sock):
+            _, payload = self.recv(sock)
+            obs.extend(self.decode_obs(payload, n))
+        return obs
+
+    def close(self):
+        for sock in self.socks:
+            self.send(sock, self.CLOSE)
+            sock.close()
+        self.socks = []
+
+
 class Task:
     def __init__(self,
                  name,
@@ -157,17 +547,22 @@ class Task:
                  single_process=True,
                  log_dir=None,
                  episode_life=True,
-                 seed=None):
+                 seed=None,
+                 async_reset=False,
+                 env_pool=None,
+                 remote_workers=None):
         if seed is None:
             seed = np.random.randint(int(1e9))
         if log_dir is not None:
             mkdir(log_dir)
-        envs = [make_env(name, seed, i, episode_life) for i in range(num_envs)]
-        if single_process:
-            Wrapper = DummyVecEnv
+        if env_pool is None:
+            env_pool = Config.ENV_POOL
+        if remote_workers is not None:
+            self.env = RemoteVecEnv(remote_workers, name, seed, num_envs, episode_life)
+        elif env_pool is not None:
+            self.env = env_pool.lease(name, seed, num_envs, episode_life)
         else:
-            Wrapper = SubprocVecEnv
-        self.env = Wrapper(envs)
+            self.env = self.make_vec_env(name, num_envs, single_process, episode_life, seed, async_reset)
         self.name = name
         self.observation_space = self.env.observation_space
         self.state_dim = int(np.prod(self.env.observation_space.shape))
@@ -180,6 +575,17 @@ class Task:
         else:
             assert 'unknown action space'
 
+    def make_vec_env(self, name, num_envs, single_process, episode_life, seed, async_reset):
+        envs = [make_env(name, seed, i, episode_life) for i in range(num_envs)]
+        if async_reset:
+            standby_envs = [make_env(name, seed, i + num_envs, episode_life) for i in range(num_envs)]
+            envs = [make_async_reset_env(env_fn, standby_fn) for env_fn, standby_fn in zip(envs, standby_envs)]
+        if single_process:
+            Wrapper = DummyVecEnv
+        else:
+            Wrapper = SubprocVecEnv
+        return Wrapper(envs)
+
     def reset(self):
         return self.env.reset()
 
@@ -188,6 +594,9 @@ class Task:
             actions = np.clip(actions, self.action_space.low, self.action_space.high)
         return self.env.step(actions)
 
+    def close(self):
+        close_obj(self.env)
+
 
 if __name__ == '__main__':
     task = Task('Hopper-v2', 5, single_process=False)
@@ -8,7 +8,7 @@ import numpy as np
 
 
 class RandomProcess(object):
-    def reset_states(self):
+    def reset_states(self, indices=None):
         pass
 
 
@@ -37,5 +37,12 @@ class OrnsteinUhlenbeckProcess(RandomProcess):
         self.x_prev = x
         return x
 
-    def reset_states(self):
-        self.x_prev = self.x0 if self.x0 is not None else np.zeros(self.size)
+    # With size (num_envs, action_dim), indices selects the envs to reset,
+    # a process of a single env (1-d size) is always reset as a whole
+    def reset_states(self, indices=None):
+        x0 = self.x0 if self.x0 is not None else np.zeros(self.size)
+        if indices is None or len(self.size) == 1:
+            self.x_prev = x0
+        else:
+            self.x_prev = np.array(self.x_prev)
+            self.x_prev[indices] = np.broadcast_to(x0, self.size)[indices]
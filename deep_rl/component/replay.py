@@ -57,37 +57,66 @@ class Storage:
 class UniformReplay(Storage):
     TransitionCLS = Transition
 
-    def __init__(self, memory_size, batch_size, n_step=1, discount=1, history_length=1, keys=None):
+    # With num_envs > 1 every feed holds one row per env, so consecutive steps of
+    # the same env are num_envs rows apart. With num_segments > 1 the memory is split
+    # into equal segments, one per data source (e.g. actor), each a ring buffer of
+    # its own so histories and n-step returns never mix rows of two sources.
+    def __init__(self, memory_size, batch_size, n_step=1, discount=1, history_length=1, keys=None, num_envs=1,
+                 num_segments=1):
         super(UniformReplay, self).__init__(memory_size, keys)
+        if memory_size % (num_envs * num_segments):
+            raise RuntimeError('memory_size should be a multiple of num_envs * num_segments')
+        self.num_envs = num_envs
         self.batch_size = batch_size
         self.n_step = n_step
         self.discount = discount
         self.history_length = history_length
-        self.pos = 0
-        self._size = 0
+        self.num_segments = num_segments
+        self.segment_size = memory_size // num_segments
+        self.segment_pos = [0] * num_segments
+        self.segment_sizes = [0] * num_segments
+        if num_segments > 1:
+            # Segments are written at their own offsets, slice assignment into
+            # a shorter list would append instead
+            self.placeholder()
 
     def compute_valid_indices(self):
+        history = (self.history_length - 1) * self.num_envs
+        n_step = self.n_step * self.num_envs
         indices = []
-        indices.extend(list(range(self.history_length - 1, self.pos - self.n_step)))
-        indices.extend(list(range(self.pos + self.history_length - 1, self.size() - self.n_step)))
+        for segment in range(self.num_segments):
+            base = segment * self.segment_size
+            pos = self.segment_pos[segment]
+            indices.extend(list(range(base + history, base + pos - n_step)))
+            indices.extend(list(range(base + pos + history, base + self.segment_sizes[segment] - n_step)))
         return np.asarray(indices)
 
-    def feed(self, data):
+    # Rows are written with slice assignment, in two pieces if they wrap around the segment
+    def feed(self, data, segment=0):
+        base = segment * self.segment_size
+        num_rows = 0
         for k, vs in data.items():
             if k not in self.keys:
                 raise RuntimeError('Undefined key')
             storage = getattr(self, k)
-            pos = self.pos
-            size = self.size()
-            for v in vs:
-                if pos >= len(storage):
-                    storage.append(v)
-                    size += 1
-                else:
-                    storage[self.pos] = v
-                pos = (pos + 1) % self.memory_size
-        self.pos = pos
-        self._size = size
+            num_rows = len(vs)
+            pos = self.segment_pos[segment]
+            i = 0
+            while i < num_rows:
+                n = min(num_rows - i, self.segment_size - pos)
+                storage[base + pos: base + pos + n] = list(vs[i: i + n])
+                pos = (pos + n) % self.segment_size
+                i += n
+        self.segment_pos[segment] = (self.segment_pos[segment] + num_rows) % self.segment_size
+        self.segment_sizes[segment] = min(self.segment_sizes[segment] + num_rows, self.segment_size)
+
+    # Uniform over all stored rows of all segments
+    def random_index(self):
+        if self.num_segments == 1:
+            return np.random.randint(0, self.size())
+        sizes = np.asarray(self.segment_sizes, dtype=np.float64)
+        segment = np.random.choice(self.num_segments, p=sizes / sizes.sum())
+        return segment * self.segment_size + np.random.randint(0, self.segment_sizes[segment])
 
     def sample(self, batch_size=None):
         if batch_size is None:
@@ -95,37 +124,40 @@ class UniformReplay(Storage):
 
         sampled_data = []
         while len(sampled_data) < batch_size:
-            transition = self.construct_transition(np.random.randint(0, self.size()))
+            transition = self.construct_transition(self.random_index())
             if transition is not None:
                 sampled_data.append(transition)
         sampled_data = zip(*sampled_data)
         sampled_data = list(map(lambda x: np.asarray(x), sampled_data))
         return Transition(*sampled_data)
 
+    # Valid windows lie in the filled part of one segment and do not cross its write position
     def valid_index(self, index):
-        if index - self.history_length + 1 >= 0 and index + self.n_step < self.pos:
+        segment = index // self.segment_size
+        index = index - segment * self.segment_size
+        pos = self.segment_pos[segment]
+        s_start = index - (self.history_length - 1) * self.num_envs
+        next_s_end = index + self.n_step * self.num_envs
+        if s_start >= 0 and next_s_end < pos:
             return True
-        if index - self.history_length + 1 >= self.pos and index + self.n_step < self.size():
+        if s_start >= pos and next_s_end < self.segment_sizes[segment]:
             return True
         return False
 
     def construct_transition(self, index):
         if not self.valid_index(index):
             return None
-        s_start = index - self.history_length + 1
+        stride = self.num_envs
+        s_start = index - (self.history_length - 1) * stride
         s_end = index
-        if s_start < 0:
-            raise RuntimeError('Invalid index')
-        next_s_start = s_start + self.n_step
-        next_s_end = s_end + self.n_step
-        if s_end < self.pos and next_s_end >= self.pos:
-            raise RuntimeError('Invalid index')
-
-        state = [self.state[i] for i in range(s_start, s_end + 1)]
-        next_state = [self.state[i] for i in range(next_s_start, next_s_end + 1)]
+        next_s_start = s_start + self.n_step * stride
+        next_s_end = s_end + self.n_step * stride
+
+        state = [self.state[i] for i in range(s_start, s_end + 1, stride)]
+        next_state = [self.state[i] for i in range(next_s_start, next_s_end + 1, stride)]
         action = self.action[s_end]
-        reward = [self.reward[i] for i in range(s_end, s_end + self.n_step)]
-        mask = [self.mask[i] for i in range(s_end, s_end + self.n_step)]
+        reward = [self.reward[i] for i in range(s_end, s_end + self.n_step * stride, stride)]
+        mask = [self.mask[i] for i in range(s_end, s_end + self.n_step * stride, stride)]
         if self.history_length == 1:
             # eliminate the extra dimension if no frame stack
             state = state[0]
@@ -140,10 +172,10 @@ class UniformReplay(Storage):
         return Transition(state=state, action=action, reward=cum_r, next_state=next_state, mask=cum_mask)
 
     def size(self):
-        return self._size
+        return sum(self.segment_sizes)
 
     def full(self):
-        return self._size == self.memory_size
+        return self.size() == self.memory_size
 
     def update_priorities(self, info):
         raise NotImplementedError
@@ -152,14 +184,21 @@ class UniformReplay(Storage):
 class PrioritizedReplay(UniformReplay):
     TransitionCLS = PrioritizedTransition
 
-    def __init__(self, memory_size, batch_size, n_step=1, discount=1, history_length=1, keys=None):
-        super(PrioritizedReplay, self).__init__(memory_size, batch_size, n_step, discount, history_length, keys)
+    def __init__(self, memory_size, batch_size, n_step=1, discount=1, history_length=1, keys=None, num_envs=1,
+                 num_segments=1):
+        super(PrioritizedReplay, self).__init__(memory_size, batch_size, n_step, discount, history_length, keys,
+                                                num_envs, num_segments)
         self.tree = SumTree(memory_size)
         self.max_priority = 1
 
-    def feed(self, data):
-        super().feed(data)
-        self.tree.add(self.max_priority, None)
+    # Tree leaves follow the storage rows, so the write position is set per row
+    def feed(self, data, segment=0):
+        base = segment * self.segment_size
+        pos = self.segment_pos[segment]
+        super().feed(data, segment)
+        for i in range(len(data['state'])):
+            self.tree.write = base + (pos + i) % self.segment_size
+            self.tree.add(self.max_priority, None)
 
     def sample(self, batch_size=None):
         if batch_size is None:
@@ -206,6 +245,9 @@ class ReplayWrapper(mp.Process):
         mp.Process.__init__(self)
         self.replay_kwargs = replay_kwargs
         self.replay_cls = replay_cls
+        # Only the replay class and its kwargs go to the child, plus the device
+        # which is not inherited under spawn/forkserver
+        self.device = Config.DEVICE
         self.cache_len = 2
         if async:
             self.pipe, self.worker_pipe = mp.Pipe()
@@ -217,6 +259,7 @@ class ReplayWrapper(mp.Process):
             self.update_priorities = self.replay.update_priorities
 
     def run(self):
+        Config.DEVICE = self.device
         replay = self.replay_cls(**self.replay_kwargs)
 
         cache = []
@@ -242,7 +285,7 @@ class ReplayWrapper(mp.Process):
         while True:
             op, data = self.worker_pipe.recv()
             if op == self.FEED:
-                replay.feed(data)
+                replay.feed(*data)
             elif op == self.SAMPLE:
                 if cache_initialized:
                     self.worker_pipe.send([cur_cache, None])
@@ -260,8 +303,8 @@ class ReplayWrapper(mp.Process):
             else:
                 raise Exception('Unknown command')
 
-    def feed(self, exp):
-        self.pipe.send([self.FEED, exp])
+    def feed(self, exp, segment=0):
+        self.pipe.send([self.FEED, (exp, segment)])
 
     def sample(self):
         self.pipe.send([self.SAMPLE, None])
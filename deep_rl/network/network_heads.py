@@ -255,6 +255,40 @@ class CategoricalActorCriticNet(nn.Module, BaseNet):
                 'v': v}
 
 
+# K critics with the same architecture evaluated in one pass. It is built from K FCBody
+# critic bodies (initialized as usual) plus their output layers, the weights of each layer
+# are stacked to [K, in, out] and every layer runs as one baddbmm over all critics.
+class EnsembleCritic(nn.Module):
+    def __init__(self, critic_body_fn, num_critics=2):
+        super(EnsembleCritic, self).__init__()
+        bodies = [critic_body_fn() for _ in range(num_critics)]
+        critics = [list(body.layers) + [layer_init(nn.Linear(body.feature_dim, 1), 1e-3)] for body in bodies]
+        self.weights = nn.ParameterList([
+            nn.Parameter(torch.stack([critic[i].weight.data.t() for critic in critics]))
+            for i in range(len(critics[0]))])
+        self.biases = nn.ParameterList([
+            nn.Parameter(torch.stack([critic[i].bias.data.unsqueeze(0) for critic in critics]))
+            for i in range(len(critics[0]))])
+        self.gate = bodies[0].gate
+        self.num_critics = num_critics
+
+    # x is [batch, in] shared by all critics or [K, batch, in], returns [K, batch, 1]
+    def forward(self, x):
+        if x.dim() == 2:
+            x = x.unsqueeze(0).expand(self.num_critics, -1, -1)
+        for i, (weight, bias) in enumerate(zip(self.weights, self.biases)):
+            x = torch.baddbmm(bias, x, weight)
+            if i < len(self.weights) - 1:
+                x = self.gate(x)
+        return x
+
+    def min(self, x):
+        return self.forward(x).min(0)[0]
+
+    def mean(self, x):
+        return self.forward(x).mean(0)
+
+
 class TD3Net(nn.Module, BaseNet):
     def __init__(self,
                  action_dim,
@@ -262,19 +296,16 @@ class TD3Net(nn.Module, BaseNet):
                  critic_body_fn,
                  actor_opt_fn,
                  critic_opt_fn,
+                 num_critics=2,
                  ):
         super(TD3Net, self).__init__()
         self.actor_body = actor_body_fn()
-        self.critic_body_1 = critic_body_fn()
-        self.critic_body_2 = critic_body_fn()
+        self.critic = EnsembleCritic(critic_body_fn, num_critics)
 
         self.fc_action = layer_init(nn.Linear(self.actor_body.feature_dim, action_dim), 1e-3)
-        self.fc_critic_1 = layer_init(nn.Linear(self.critic_body_1.feature_dim, 1), 1e-3)
-        self.fc_critic_2 = layer_init(nn.Linear(self.critic_body_2.feature_dim, 1), 1e-3)
 
         self.actor_params = list(self.actor_body.parameters()) + list(self.fc_action.parameters())
-        self.critic_params = list(self.critic_body_1.parameters()) + list(self.fc_critic_1.parameters()) +\
-                             list(self.critic_body_2.parameters()) + list(self.fc_critic_2.parameters())
+        self.critic_params = list(self.critic.parameters())
 
         self.actor_opt = actor_opt_fn(self.actor_params)
         self.critic_opt = critic_opt_fn(self.critic_params)
@@ -284,10 +315,11 @@ class TD3Net(nn.Module, BaseNet):
         obs = tensor(obs)
         return torch.tanh(self.fc_action(self.actor_body(obs)))
 
-    def q(self, obs, a):
+    # [num_critics, batch, 1]
+    def q_all(self, obs, a):
         obs = tensor(obs)
         a = tensor(a)
-        x = torch.cat([obs, a], dim=1)
-        q_1 = self.fc_critic_1(self.critic_body_1(x))
-        q_2 = self.fc_critic_2(self.critic_body_2(x))
-        return q_1, q_2
+        return self.critic(torch.cat([obs, a], dim=1))
+
+    def q(self, obs, a):
+        return self.q_all(obs, a).unbind(0)
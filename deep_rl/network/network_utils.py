@@ -38,28 +38,24 @@ class NoisyLinear(nn.Module):
 
         self.weight_mu = nn.Parameter(torch.zeros((out_features, in_features)), requires_grad=True)
         self.weight_sigma = nn.Parameter(torch.zeros((out_features, in_features)), requires_grad=True)
-        self.register_buffer('weight_epsilon', torch.zeros((out_features, in_features)))
+        # Factorized weight noise, only the transformed input and output vectors are kept
+        self.register_buffer('weight_epsilon_in', torch.zeros(in_features))
+        self.register_buffer('weight_epsilon_out', torch.zeros(out_features))
 
         self.bias_mu = nn.Parameter(torch.zeros(out_features), requires_grad=True)
         self.bias_sigma = nn.Parameter(torch.zeros(out_features), requires_grad=True)
         self.register_buffer('bias_epsilon', torch.zeros(out_features))
 
-        self.register_buffer('noise_in', torch.zeros(in_features))
-        self.register_buffer('noise_out_weight', torch.zeros(out_features))
-        self.register_buffer('noise_out_bias', torch.zeros(out_features))
-
         self.reset_parameters()
         self.reset_noise()
 
+    # x (W_mu + W_sigma * eps_out eps_in^T)^T = x W_mu^T + ((x * eps_in) W_sigma^T) * eps_out
     def forward(self, x):
-        if self.training:
-            weight = self.weight_mu + self.weight_sigma.mul(self.weight_epsilon)
-            bias = self.bias_mu + self.bias_sigma.mul(self.bias_epsilon)
-        else:
-            weight = self.weight_mu
-            bias = self.bias_mu
-
-        return F.linear(x, weight, bias)
+        if not self.training:
+            return F.linear(x, self.weight_mu, self.bias_mu)
+        bias = self.bias_mu + self.bias_sigma.mul(self.bias_epsilon)
+        noise = F.linear(x * self.weight_epsilon_in, self.weight_sigma) * self.weight_epsilon_out
+        return F.linear(x, self.weight_mu, bias) + noise
 
     def reset_parameters(self):
         mu_range = 1 / math.sqrt(self.weight_mu.size(1))
@@ -71,13 +67,8 @@ class NoisyLinear(nn.Module):
         self.bias_sigma.data.fill_(self.std_init / math.sqrt(self.bias_sigma.size(0)))
 
     def reset_noise(self):
-        self.noise_in.normal_(std=Config.NOISY_LAYER_STD)
-        self.noise_out_weight.normal_(std=Config.NOISY_LAYER_STD)
-        self.noise_out_bias.normal_(std=Config.NOISY_LAYER_STD)
-
-        self.weight_epsilon.copy_(self.transform_noise(self.noise_out_weight).ger(
-            self.transform_noise(self.noise_in)))
-        self.bias_epsilon.copy_(self.transform_noise(self.noise_out_bias))
+        for epsilon in [self.weight_epsilon_in, self.weight_epsilon_out, self.bias_epsilon]:
+            epsilon.copy_(self.transform_noise(epsilon.normal_(std=Config.NOISY_LAYER_STD)))
 
     def transform_noise(self, x):
         return x.sign().mul(x.abs().sqrt())
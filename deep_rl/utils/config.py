@@ -13,6 +13,7 @@ class Config:
     NOISY_LAYER_STD = 0.1
     DEFAULT_REPLAY = 'replay'
     PRIORITIZED_REPLAY = 'prioritized_replay'
+    ENV_POOL = None
 
     def __init__(self):
         self.parser = argparse.ArgumentParser()
@@ -66,6 +67,26 @@ class Config:
         self.shared_repr = False
         self.noisy_linear = False
         self.n_step = 1
+        self.num_actors = 1
+        self.actor_backend = 'process'
+        self.num_learners = 1
+        self.apex_epsilon = 0.4
+        self.apex_alpha = 7
+        self.per_env_epsilon = False
+        self.versioned_weights = False
+        self.weight_publish_interval = 1
+        self.inference_server = False
+        self.inference_max_batch_size = 32
+        self.inference_max_wait = 1e-3
+        self.decoupled_learner = False
+        self.replay_ratio = None
+        self.max_update_lag = 10
+        self.rollout_batch_size = 1
+        self.vtrace_rho_clip = 1.0
+        self.vtrace_c_clip = 1.0
+        self.fused_forward = False
+        self.flat_parameters = False
+        self.utd_ratio = 1
 
     @property
     def eval_env(self):
@@ -78,6 +99,21 @@ class Config:
         self.action_dim = env.action_dim
         self.task_name = env.name
 
+    # Picklable copy handed to child processes, so they also start under spawn/forkserver.
+    # The parser, the eval env and lambdas stay behind; task_fn is kept and has to be
+    # picklable (e.g. functools.partial(Task, game)) unless processes are forked.
+    def spec(self):
+        spec = Config.__new__(Config)
+        for key, value in self.__dict__.items():
+            if key in ['parser', '_Config__eval_env']:
+                continue
+            qualname = getattr(value, '__qualname__', '')
+            if key != 'task_fn' and ('<lambda>' in qualname or '<locals>' in qualname):
+                continue
+            spec.__dict__[key] = value
+        spec.__dict__['_Config__eval_env'] = None
+        return spec
+
     def add_argument(self, *args, **kwargs):
         self.parser.add_argument(*args, **kwargs)
 
@@ -20,21 +20,29 @@ def run_steps(agent):
     config = agent.config
     agent_name = agent.__class__.__name__
     t0 = time.time()
+    # Agents may advance total_steps by more than one per step,
+    # so intervals fire whenever a multiple of them is crossed
+    last_steps = -1
     while True:
-        if config.save_interval and not agent.total_steps % config.save_interval:
+        if crossed(config.save_interval, last_steps, agent.total_steps):
             agent.save('data/%s-%s-%d' % (agent_name, config.tag, agent.total_steps))
-        if config.log_interval and not agent.total_steps % config.log_interval:
+        if crossed(config.log_interval, last_steps, agent.total_steps):
             agent.logger.info('steps %d, %.2f steps/s' % (agent.total_steps, config.log_interval / (time.time() - t0)))
             t0 = time.time()
-        if config.eval_interval and not agent.total_steps % config.eval_interval:
+        if crossed(config.eval_interval, last_steps, agent.total_steps):
             agent.eval_episodes()
         if config.max_steps and agent.total_steps >= config.max_steps:
             agent.close()
             break
+        last_steps = agent.total_steps
         agent.step()
         agent.switch_task()
 
 
+def crossed(interval, last_steps, steps):
+    return interval and steps // interval > last_steps // interval
+
+
 def get_time_str():
     return datetime.datetime.now().strftime("%y%m%d-%H%M%S")
 
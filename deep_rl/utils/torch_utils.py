@@ -48,6 +48,34 @@ def huber(x, k=1.0):
     return torch.where(x.abs() < k, 0.5 * x.pow(2), k * (x.abs() - 0.5 * k))
 
 
+# Quantile Huber loss of predicted quantiles [B, N] at fractions tau ([N], or [B, N] for
+# IQN style sampled fractions) against target samples [B, M], summed over quantiles and
+# averaged over targets. The [B, M, N] pairwise differences only exist chunk by chunk,
+# the gradient w.r.t. the quantiles is accumulated during the forward pass.
+class QuantileHuberLoss(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, quantiles, target, tau, k=1.0, chunk_size=32):
+        tau = tau.view(-1, 1, quantiles.size(-1))
+        loss = quantiles.new_zeros(quantiles.size(0))
+        grad = torch.zeros_like(quantiles)
+        for start in range(0, target.size(1), chunk_size):
+            diff = target[:, start: start + chunk_size].unsqueeze(-1) - quantiles.unsqueeze(1)
+            weight = (tau - (diff < 0).float()).abs()
+            loss += (huber(diff, k) * weight).sum((1, 2))
+            grad -= (diff.clamp(-k, k) * weight).sum(1)
+        ctx.save_for_backward(grad / target.size(1))
+        return loss / target.size(1)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad, = ctx.saved_tensors
+        return grad * grad_output.unsqueeze(-1), None, None, None, None
+
+
+def quantile_huber_loss(quantiles, target, tau, k=1.0, chunk_size=32):
+    return QuantileHuberLoss.apply(quantiles, target.detach(), tau, k, chunk_size)
+
+
 def epsilon_greedy(epsilon, x):
     if len(x.shape) == 1:
         return np.random.randint(len(x)) if np.random.rand() < epsilon else np.argmax(x)
@@ -206,5 +234,83 @@ class Grads:
         return grad
 
 
+# Double-buffered copy of a network's parameters in shared memory.
+# The learner writes the slot actors are not reading and then bumps the version,
+# actors copy the newest version between steps. Neither side takes a lock.
+class VersionedWeights:
+    def __init__(self, network):
+        size = sum(param.numel() for param in network.parameters())
+        self.slots = torch.zeros((2, size)).share_memory_()
+        self.version = torch.zeros(1, dtype=torch.long).share_memory_()
+        # Last version pulled by each reader network, readers may share this object (thread backend)
+        self.local_versions = {}
+        self.publish(network)
+
+    def copy(self, network, slot, publish):
+        offset = 0
+        for param in network.parameters():
+            view = slot[offset: offset + param.numel()].view_as(param)
+            if publish:
+                view.copy_(param.data)
+            else:
+                param.data.copy_(view)
+            offset += param.numel()
+
+    def publish(self, network):
+        version = int(self.version[0]) + 1
+        self.copy(network, self.slots[version % 2], publish=True)
+        self.version[0] = version
+
+    def pull(self, network):
+        while True:
+            version = int(self.version[0])
+            if version == self.local_versions.get(id(network)):
+                return
+            self.copy(network, self.slots[version % 2], publish=False)
+            # publish(version + 2) rewrites this slot and starts while the version is still
+            # version + 1, so the copy is only known to be consistent if nothing was published
+            if int(self.version[0]) == version:
+                self.local_versions[id(network)] = version
+                return
+
+
+# Moves the parameters of a network (and, with grad, their gradients) into one contiguous
+# buffer, every parameter becomes a view of it. The optimizers built on the parameters keep
+# working, while whole-network operations below are a single tensor op.
+class FlatParameters:
+    def __init__(self, network, grad=True):
+        params = list(network.parameters())
+        self.data = torch.cat([param.data.view(-1) for param in params])
+        self.grad = torch.zeros_like(self.data) if grad else None
+        offset = 0
+        for param in params:
+            numel = param.numel()
+            param.data = self.data[offset: offset + numel].view_as(param)
+            if grad:
+                param.grad = self.grad[offset: offset + numel].view_as(param)
+            offset += numel
+
+    def zero_grad(self):
+        self.grad.zero_()
+
+    def clip_grad_norm_(self, max_norm):
+        total_norm = self.grad.norm()
+        clip_coef = max_norm / (total_norm + 1e-6)
+        if clip_coef < 1:
+            self.grad.mul_(clip_coef)
+        return total_norm
+
+    def copy_(self, src):
+        self.data.copy_(src.data)
+
+    # Polyak averaging, self = (1 - weight) * self + weight * src
+    def lerp_(self, src, weight):
+        self.data.lerp_(src.data, weight)
+
+    def share_memory_(self):
+        self.data.share_memory_()
+        return self
+
+
 def escape_float(x):
     return ('%s' % x).replace('.', '\.')
\ No newline at end of file
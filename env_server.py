@@ -0,0 +1,17 @@
+#######################################################################
+# Copyright (C) 2017 Shangtong Zhang(zhangshangtong.cpp@gmail.com)    #
+# Permission given to modify the code as long as you keep this        #
+# declaration at the top                                              #
+#######################################################################
+
+from deep_rl import *
+from deep_rl.component.envs import RemoteEnvServer
+
+# Serves envs to a learner that uses Task(..., remote_workers=['host:port', ...])
+if __name__ == '__main__':
+    set_one_thread()
+    cf = Config()
+    cf.add_argument('--host', type=str, default='0.0.0.0')
+    cf.add_argument('--port', type=int, default=6000)
+    cf.merge()
+    RemoteEnvServer(cf.host, cf.port).serve_forever()
@@ -4,6 +4,7 @@
 # declaration at the top                                              #
 #######################################################################
 
+import functools
 from deep_rl import *
 
 
@@ -17,8 +18,8 @@ def dqn_feature(**kwargs):
     config = Config()
     config.merge(kwargs)
 
-    config.task_fn = lambda: Task(config.game)
-    config.eval_env = config.task_fn()
+    config.task_fn = functools.partial(Task, config.game, num_envs=config.num_workers)
+    config.eval_env = Task(config.game)
 
     config.optimizer_fn = lambda params: torch.optim.RMSprop(params, 0.001)
     config.network_fn = lambda: VanillaNet(config.action_dim, FCBody(config.state_dim))
@@ -28,12 +29,16 @@ def dqn_feature(**kwargs):
     config.discount = 0.99
     config.max_steps = 1e5
 
+    # One segment per actor and one row per env and step
+    rows_per_step = config.num_workers * config.num_actors
     replay_kwargs = dict(
-        memory_size=int(1e4),
+        memory_size=int(1e4) // rows_per_step * rows_per_step,
         batch_size=config.batch_size,
         n_step=config.n_step,
         discount=config.discount,
-        history_length=config.history_length)
+        history_length=config.history_length,
+        num_envs=config.num_workers,
+        num_segments=config.num_actors)
 
     config.replay_fn = lambda: ReplayWrapper(config.replay_cls, replay_kwargs, config.async_replay)
     config.replay_eps = 0.01
@@ -61,8 +66,8 @@ def dqn_pixel(**kwargs):
     config = Config()
     config.merge(kwargs)
 
-    config.task_fn = lambda: Task(config.game)
-    config.eval_env = config.task_fn()
+    config.task_fn = functools.partial(Task, config.game, num_envs=config.num_workers)
+    config.eval_env = Task(config.game)
 
     config.optimizer_fn = lambda params: torch.optim.RMSprop(
         params, lr=0.00025, alpha=0.95, eps=0.01, centered=True)
@@ -73,12 +78,16 @@ def dqn_pixel(**kwargs):
     config.discount = 0.99
     config.history_length = 4
     config.max_steps = int(2e7)
+    # One segment per actor and one row per env and step
+    rows_per_step = config.num_workers * config.num_actors
     replay_kwargs = dict(
-        memory_size=int(1e6),
+        memory_size=int(1e6) // rows_per_step * rows_per_step,
         batch_size=config.batch_size,
         n_step=config.n_step,
         discount=config.discount,
         history_length=config.history_length,
+        num_envs=config.num_workers,
+        num_segments=config.num_actors,
     )
     config.replay_fn = lambda: ReplayWrapper(config.replay_cls, replay_kwargs, config.async_replay)
     config.replay_eps = 0.01
@@ -104,7 +113,7 @@ def quantile_regression_dqn_feature(**kwargs):
     config = Config()
     config.merge(kwargs)
 
-    config.task_fn = lambda: Task(config.game)
+    config.task_fn = functools.partial(Task, config.game)
     config.eval_env = config.task_fn()
     config.optimizer_fn = lambda params: torch.optim.RMSprop(params, 0.001)
     config.network_fn = lambda: QuantileNet(config.action_dim, config.num_quantiles, FCBody(config.state_dim))
@@ -133,7 +142,7 @@ def quantile_regression_dqn_pixel(**kwargs):
     config = Config()
     config.merge(kwargs)
 
-    config.task_fn = lambda: Task(config.game)
+    config.task_fn = functools.partial(Task, config.game)
     config.eval_env = config.task_fn()
 
     config.optimizer_fn = lambda params: torch.optim.Adam(params, lr=0.00005, eps=0.01 / 32)
@@ -167,7 +176,7 @@ def categorical_dqn_feature(**kwargs):
     config = Config()
     config.merge(kwargs)
 
-    config.task_fn = lambda: Task(config.game)
+    config.task_fn = functools.partial(Task, config.game)
     config.eval_env = config.task_fn()
     config.optimizer_fn = lambda params: torch.optim.RMSprop(params, 0.001)
     config.network_fn = lambda: CategoricalNet(config.action_dim, config.categorical_n_atoms, FCBody(config.state_dim))
@@ -199,7 +208,7 @@ def categorical_dqn_pixel(**kwargs):
     config = Config()
     config.merge(kwargs)
 
-    config.task_fn = lambda: Task(config.game)
+    config.task_fn = functools.partial(Task, config.game)
     config.eval_env = config.task_fn()
     config.optimizer_fn = lambda params: torch.optim.Adam(params, lr=0.00025, eps=0.01 / 32)
     config.network_fn = lambda: CategoricalNet(config.action_dim, config.categorical_n_atoms, NatureConvBody())
@@ -237,7 +246,7 @@ def rainbow_feature(**kwargs):
     config = Config()
     config.merge(kwargs)
 
-    config.task_fn = lambda: Task(config.game)
+    config.task_fn = functools.partial(Task, config.game)
     config.eval_env = config.task_fn()
 
     config.max_steps = 1e5
@@ -290,7 +299,7 @@ def rainbow_pixel(**kwargs):
     config = Config()
     config.merge(kwargs)
 
-    config.task_fn = lambda: Task(config.game)
+    config.task_fn = functools.partial(Task, config.game)
     config.eval_env = config.task_fn()
 
     config.max_steps = int(2e7)
@@ -404,6 +413,57 @@ def a2c_continuous(**kwargs):
     run_steps(A2CAgent(config))
 
 
+# IMPALA
+def impala_feature(**kwargs):
+    generate_tag(kwargs)
+    kwargs.setdefault('log_level', 0)
+    kwargs.setdefault('num_actors', 4)
+    config = Config()
+    config.merge(kwargs)
+
+    config.num_workers = 5
+    config.task_fn = functools.partial(Task, config.game, num_envs=config.num_workers)
+    config.eval_env = Task(config.game)
+    config.optimizer_fn = lambda params: torch.optim.RMSprop(params, 0.001)
+    config.network_fn = lambda: CategoricalActorCriticNet(
+        config.state_dim, config.action_dim, FCBody(config.state_dim, gate=F.tanh))
+    config.discount = 0.99
+    config.use_gae = True
+    config.gae_tau = 0.95
+    config.entropy_weight = 0.01
+    config.rollout_length = 5
+    config.rollout_batch_size = 2
+    config.gradient_clip = 0.5
+    config.async_actor = True
+    run_steps(IMPALAAgent(config))
+
+
+def impala_pixel(**kwargs):
+    generate_tag(kwargs)
+    kwargs.setdefault('log_level', 0)
+    kwargs.setdefault('num_actors', 4)
+    config = Config()
+    config.merge(kwargs)
+
+    config.num_workers = 8
+    config.task_fn = functools.partial(Task, config.game, num_envs=config.num_workers)
+    config.eval_env = Task(config.game)
+    config.optimizer_fn = lambda params: torch.optim.RMSprop(params, lr=1e-4, alpha=0.99, eps=1e-5)
+    config.network_fn = lambda: CategoricalActorCriticNet(config.state_dim, config.action_dim, NatureConvBody())
+    config.state_normalizer = ImageNormalizer()
+    config.reward_normalizer = SignNormalizer()
+    config.discount = 0.99
+    config.use_gae = True
+    config.gae_tau = 1.0
+    config.entropy_weight = 0.01
+    config.rollout_length = 20
+    config.rollout_batch_size = 2
+    config.gradient_clip = 5
+    config.async_actor = True
+    config.max_steps = int(2e7)
+    run_steps(IMPALAAgent(config))
+
+
 # N-Step DQN
 def n_step_dqn_feature(**kwargs):
     generate_tag(kwargs)
@@ -557,8 +617,8 @@ def ddpg_continuous(**kwargs):
     config = Config()
     config.merge(kwargs)
 
-    config.task_fn = lambda: Task(config.game)
-    config.eval_env = config.task_fn()
+    config.task_fn = lambda: Task(config.game, num_envs=config.num_workers)
+    config.eval_env = Task(config.game)
     config.max_steps = int(1e6)
     config.eval_interval = int(1e4)
     config.eval_episodes = 20
@@ -570,10 +630,14 @@ def ddpg_continuous(**kwargs):
         actor_opt_fn=lambda params: torch.optim.Adam(params, lr=1e-3),
         critic_opt_fn=lambda params: torch.optim.Adam(params, lr=1e-3))
 
-    config.replay_fn = lambda: UniformReplay(memory_size=int(1e6), batch_size=100)
+    # One row per env and step, memory_size has to be a multiple of num_envs
+    config.batch_size = 100
+    config.replay_fn = lambda: UniformReplay(memory_size=int(1e6) // config.num_workers * config.num_workers,
+                                             batch_size=config.batch_size * config.utd_ratio,
+                                             num_envs=config.num_workers)
     config.discount = 0.99
     config.random_process_fn = lambda: OrnsteinUhlenbeckProcess(
-        size=(config.action_dim,), std=LinearSchedule(0.2))
+        size=(config.num_workers, config.action_dim), std=LinearSchedule(0.2))
     config.warm_up = int(1e4)
     config.target_network_mix = 5e-3
     run_steps(DDPGAgent(config))
@@ -586,8 +650,8 @@ def td3_continuous(**kwargs):
     config = Config()
     config.merge(kwargs)
 
-    config.task_fn = lambda: Task(config.game)
-    config.eval_env = config.task_fn()
+    config.task_fn = lambda: Task(config.game, num_envs=config.num_workers)
+    config.eval_env = Task(config.game)
     config.max_steps = int(1e6)
     config.eval_interval = int(1e4)
     config.eval_episodes = 20
@@ -600,15 +664,17 @@ def td3_continuous(**kwargs):
         actor_opt_fn=lambda params: torch.optim.Adam(params, lr=1e-3),
         critic_opt_fn=lambda params: torch.optim.Adam(params, lr=1e-3))
 
+    config.batch_size = 100
     replay_kwargs = dict(
-        memory_size=int(1e6),
-        batch_size=100,
+        memory_size=int(1e6) // config.num_workers * config.num_workers,
+        batch_size=config.batch_size * config.utd_ratio,
+        num_envs=config.num_workers,
     )
 
     config.replay_fn = lambda: ReplayWrapper(UniformReplay, replay_kwargs)
     config.discount = 0.99
     config.random_process_fn = lambda: GaussianProcess(
-        size=(config.action_dim,), std=LinearSchedule(0.1))
+        size=(config.num_workers, config.action_dim), std=LinearSchedule(0.1))
     config.td3_noise = 0.2
     config.td3_noise_clip = 0.5
     config.td3_delay = 2
@@ -625,6 +691,9 @@ if __name__ == '__main__':
     # -1 is CPU, a positive integer is the index of GPU
     select_device(-1)
     # select_device(0)
+    # Actor, replay and inference server processes also start under spawn/forkserver,
+    # hogwild learners (num_learners > 1) need fork
+    # mp.set_start_method('spawn')
 
     game = 'CartPole-v0'
     # dqn_feature(game=game, n_step=1, replay_cls=UniformReplay, async_replay=True, noisy_linear=True)
@@ -632,7 +701,10 @@ if __name__ == '__main__':
     # categorical_dqn_feature(game=game)
     # rainbow_feature(game=game)
     # a2c_feature(game=game)
+    # a2c_feature(game=game, num_learners=4)
+    # impala_feature(game=game)
     # n_step_dqn_feature(game=game)
+    # n_step_dqn_feature(game=game, num_learners=4)
     # option_critic_feature(game=game)
 
     game = 'HalfCheetah-v2'
@@ -644,10 +716,12 @@ if __name__ == '__main__':
 
     game = 'BreakoutNoFrameskip-v4'
     dqn_pixel(game=game, n_step=1, replay_cls=UniformReplay, async_replay=False)
+    # dqn_pixel(game=game, num_actors=4)
     # quantile_regression_dqn_pixel(game=game)
     # categorical_dqn_pixel(game=game)
     # rainbow_pixel(game=game, async_replay=False)
     # a2c_pixel(game=game)
+    # impala_pixel(game=game)
     # n_step_dqn_pixel(game=game)
     # option_critic_pixel(game=game)
     # ppo_pixel(game=game)
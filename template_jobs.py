@@ -114,6 +114,34 @@ def batch_mujoco():
     exit()
 
 
+def sweep_classic_control():
+    cf = Config()
+    cf.add_argument('--i', type=int, default=0)
+    cf.add_argument('--j', type=int, default=1)
+    cf.merge()
+
+    games = ['CartPole-v0', 'Acrobot-v1']
+    algos = [
+        dqn_feature,
+        a2c_feature,
+        n_step_dqn_feature,
+    ]
+
+    params = []
+    for game in games:
+        for algo in algos:
+            for r in range(5):
+                params.append([algo, dict(game=game, run=r, remark=algo.__name__)])
+
+    # Job i of j runs its share of the sweep sequentially,
+    # leasing envs from one pool so workers only start once
+    Config.ENV_POOL = EnvPool(num_workers=8)
+    for algo, param in params[cf.i::cf.j]:
+        algo(**param)
+    Config.ENV_POOL.close()
+    exit()
+
+
 if __name__ == '__main__':
     mkdir('log')
     mkdir('data')
@@ -122,5 +150,8 @@ if __name__ == '__main__':
     # select_device(0)
     # batch_atari()
 
+    # select_device(-1)
+    # sweep_classic_control()
+
     select_device(-1)
     batch_mujoco()
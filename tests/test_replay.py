@@ -0,0 +1,28 @@
+import numpy as np
+from deep_rl.component.replay import UniformReplay, PrioritizedReplay
+
+
+def feed_steps(replay, segment, states):
+    for state in states:
+        replay.feed(dict(state=[state], action=[0], reward=[1.0], mask=[1]), segment)
+
+
+def test_segments_are_written_at_their_offsets():
+    replay = UniformReplay(memory_size=8, batch_size=4, num_segments=2)
+    feed_steps(replay, 1, [10, 11, 12])
+    assert replay.state[4:7] == [10, 11, 12]
+    assert replay.state[:4] == [None] * 4
+    feed_steps(replay, 0, [0, 1])
+    assert replay.state[:2] == [0, 1]
+    assert replay.state[4:7] == [10, 11, 12]
+    assert replay.size() == 5
+
+
+def test_transitions_stay_within_a_segment():
+    for replay_cls in [UniformReplay, PrioritizedReplay]:
+        replay = replay_cls(memory_size=8, batch_size=16, num_segments=2)
+        feed_steps(replay, 0, [0, 1, 2])
+        feed_steps(replay, 1, [10, 11, 12])
+        transitions = replay.sample()
+        assert np.all(transitions.next_state == transitions.state + 1)
+        assert set(transitions.state.tolist()) <= {0, 1, 10, 11}